@@ -0,0 +1,57 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+import pytorch_lightning as pl
+import torch as T
+
+from src import metric, pipeline
+from src.run.pipeline import NativeTrainer, datagen
+
+# mode: (default pipeline, description of the variant compared against the float32 pl.Trainer)
+modes = {
+    'bf16': ('BiasedNLLNCMPipeline', 'bfloat16 autocast'),
+    'native': ('NLLNCMMaxPipeline', 'native training loop'),
+}
+
+parser = argparse.ArgumentParser(description="NCM training benchmark against float32 pl.Trainer")
+parser.add_argument('--mode', '-m', choices=modes, default='bf16', help="variant to benchmark")
+parser.add_argument('--pipeline', '-p', default=None,
+                    help="pipeline to benchmark (default: depends on the mode)")
+parser.add_argument('--graph', '-G', default='dat/cg/backdoor.cg', help="causal graph file")
+parser.add_argument('--n-samples', '-n', type=int, default=4096, help="number of data samples")
+parser.add_argument('--n-epochs', type=int, default=200, help="number of training epochs")
+parser.add_argument('--n-trials', '-t', type=int, default=3, help="number of seeds")
+args = parser.parse_args()
+
+cls = getattr(pipeline, args.pipeline or modes[args.mode][0])
+rows = []
+for trial in range(args.n_trials):
+    for variant in (False, True):
+        T.manual_seed(trial)
+        np.random.seed(trial)
+        ctm, dat = datagen(args.graph, n=args.n_samples)
+        m = cls(ctm, dat, args.graph)
+        if args.mode == 'bf16':
+            m.bf16 = variant
+        if args.mode == 'native' and variant:
+            trainer = NativeTrainer(args.n_epochs)
+        else:
+            trainer = pl.Trainer(max_epochs=args.n_epochs, logger=False, enable_checkpointing=False,
+                                 enable_progress_bar=False, accelerator='cpu')
+        start_time = time.time()
+        trainer.fit(m)
+        elapsed = time.time() - start_time
+        true_ate = metric.metrics.ate(ctm)
+        ncm_ate = metric.metrics.ate(m.ncm, n=100000)
+        rows.append({'trial': trial, args.mode: variant,
+                     'steps_per_sec': trainer.global_step / elapsed,
+                     'err_ncm_ate': abs(true_ate - ncm_ate)})
+        print(rows[-1])
+
+df = pd.DataFrame(rows)
+summary = df.groupby(args.mode)[['steps_per_sec', 'err_ncm_ate']].mean()
+print(summary)
+print('%s throughput gain: %.2fx' % (modes[args.mode][1], summary.loc[True, 'steps_per_sec']
+                                     / summary.loc[False, 'steps_per_sec']))
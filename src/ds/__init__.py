@@ -1,3 +1,4 @@
 from .causal_graph import CausalGraph
+from .count_table import CountTable, ProbabilityTable
 
-__all__ = ['CausalGraph']
+__all__ = ['CausalGraph', 'CountTable', 'ProbabilityTable']
@@ -0,0 +1,176 @@
+import pandas as pd
+import torch as T
+
+
+class CodedTable:
+    """
+    Table over integer-coded configurations of binary variables.
+
+    A configuration is coded by concatenating the bits of the variables in order, most significant
+    first, so for width-1 variables codes line up with SCM.space() and CTM.table(). Codes are kept
+    sorted and unique, aligned with the table's values.
+
+    Indexing a table by a variable name returns its (k, width) values over the k stored
+    configurations.
+    """
+    max_bits = 62
+    dense_bits = 20  # count with bincount over all codes up to this many bits
+
+    def __init__(self, sizes, codes=None):
+        self.sizes = dict(sizes)
+        self.bits = sum(self.sizes.values())
+        assert self.bits <= self.max_bits, 'too many bits to code: %d' % self.bits
+        self.codes = T.zeros(0, dtype=T.long) if codes is None else codes.long().cpu()
+        self._columns = None
+
+    def encode(self, dat):
+        n = len(next(iter(dat.values())))
+        codes = T.zeros(n, dtype=T.long)
+        for k, w in self.sizes.items():
+            bits = dat[k].detach().long().cpu().reshape(n, w)
+            for i in range(w):
+                codes = (codes << 1) | bits[:, i]
+        return codes
+
+    def decode(self, codes=None):
+        if codes is None:
+            if self._columns is None:
+                self._columns = self.decode(self.codes)
+            return self._columns
+        dat = {}
+        shift = self.bits
+        for k, w in self.sizes.items():
+            shift -= w
+            dat[k] = (codes[:, None] >> (shift + T.arange(w - 1, -1, -1))) & 1
+        return dat
+
+    def recode(self, sizes):
+        """Codes of the stored configurations under a different variable order."""
+        return CodedTable(sizes).encode(self.decode())
+
+    def keys(self):
+        return self.sizes.keys()
+
+    def __iter__(self):
+        return iter(self.sizes)
+
+    def __contains__(self, k):
+        return k in self.sizes
+
+    def __getitem__(self, k):
+        return self.decode()[k]
+
+    def values(self):
+        return self.decode().values()
+
+    def items(self):
+        return self.decode().items()
+
+    def frame(self):
+        """One row per configuration, with each variable as an integer."""
+        return pd.DataFrame({k: (v * (1 << T.arange(v.shape[1] - 1, -1, -1))).sum(dim=1).numpy()
+                             for k, v in self.items()})
+
+
+class CountTable(CodedTable):
+    """
+    Empirical joint distribution as counts of the observed configurations.
+
+    Tables built from different sample streams can be merged. Code that only needs
+    per-configuration values can use a CountTable in place of a sample dict, weighting by counts.
+    """
+
+    def __init__(self, sizes, codes=None, counts=None):
+        super().__init__(sizes, codes)
+        self.counts = T.zeros(0, dtype=T.long) if counts is None else counts.long().cpu()
+
+    @classmethod
+    def from_samples(cls, dat):
+        return cls({k: v.shape[1] if v.dim() > 1 else 1 for k, v in dat.items()}).update(dat)
+
+    @classmethod
+    def from_dense(cls, sizes, counts):
+        """Build a table from counts of every configuration, indexed by code."""
+        codes = T.nonzero(counts).flatten()
+        return cls(sizes, codes, counts[codes])
+
+    def add(self, codes, counts):
+        """Accumulate counts of (possibly repeated) codes in place."""
+        self._columns = None
+        codes = T.cat((self.codes, codes.long().cpu()))
+        counts = T.cat((self.counts, counts.long().cpu()))
+        if self.bits <= self.dense_bits:
+            dense = T.zeros(2 ** self.bits, dtype=T.long).index_add_(0, codes, counts)
+            self.codes = T.nonzero(dense).flatten()
+            self.counts = dense[self.codes]
+        else:
+            self.codes, inverse = T.unique(codes, return_inverse=True)
+            self.counts = T.zeros(len(self.codes), dtype=T.long).index_add_(0, inverse, counts)
+        return self
+
+    def update(self, dat):
+        """Accumulate a dict of (n, width) samples in place."""
+        codes = self.encode(dat)
+        return self.add(codes, T.ones_like(codes))
+
+    def merge(self, other):
+        assert self.sizes == other.sizes
+        return CountTable(self.sizes, self.codes, self.counts).add(other.codes, other.counts)
+
+    __add__ = merge
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    def probabilities(self):
+        return ProbabilityTable(self.sizes, self.codes, self.counts.double() / self.n)
+
+    def dense(self):
+        """Counts of every configuration, indexed by code."""
+        return T.zeros(2 ** self.bits, dtype=T.long).index_add_(0, self.codes, self.counts)
+
+    def to_frame(self):
+        """One row per configuration, with each variable as an integer and a 'count' column."""
+        df = self.frame()
+        df['count'] = self.counts.numpy()
+        return df
+
+    def to_samples(self):
+        """Expand back to a dict of (n, width) samples, in configuration order."""
+        return {k: v.repeat_interleave(self.counts, dim=0) for k, v in self.items()}
+
+
+class ProbabilityTable(CodedTable):
+    """Joint distribution as probabilities aligned with configuration codes."""
+
+    def __init__(self, sizes, codes, probs):
+        super().__init__(sizes, codes)
+        self.probs = probs.double().cpu()
+
+    @classmethod
+    def from_dense(cls, sizes, probs, drop_zeros=False):
+        """Build a table from the probabilities of every configuration, indexed by code."""
+        probs = probs.detach().flatten()
+        codes = T.nonzero(probs).flatten() if drop_zeros else T.arange(len(probs))
+        return cls(sizes, codes, probs[codes])
+
+    def reorder(self, sizes):
+        """The same table with configurations coded under a different variable order."""
+        codes, order = self.recode(sizes).sort()
+        return ProbabilityTable(sizes, codes, self.probs[order])
+
+    def lookup(self, codes, default=0.):
+        """Probabilities of the given codes, with default for configurations not in the table."""
+        probs = T.full(codes.shape, default, dtype=T.float64)
+        if len(self.codes):
+            i = T.searchsorted(self.codes, codes).clamp(max=len(self.codes) - 1)
+            found = self.codes[i] == codes
+            probs[found] = self.probs[i[found]]
+        return probs
+
+    def to_frame(self):
+        """One row per configuration, with each variable as an integer and a 'P(V)' column."""
+        df = self.frame()
+        df['P(V)'] = self.probs.numpy()
+        return df
@@ -10,7 +10,7 @@ import numpy as np  # noqa: E402
 import torch as T  # noqa: E402
 
 from src import pipeline  # noqa: E402
-from src.run.pipeline import run_id  # noqa: E402
+from src.run.pipeline import run_id, run_id_packed  # noqa: E402
 from src.ds.causal_graph import sample_cg, CausalGraph
 
 warnings.filterwarnings(
@@ -47,7 +47,21 @@ parser.add_argument('--n-samples', '-n', type=int, default=10000, help="number o
 parser.add_argument('--dim', '-d', type=int, default=1, help="dimensionality of variables (default: 1)")
 parser.add_argument('--n-epochs', type=int, default=1000, help="number of epochs (default: 1000)")
 parser.add_argument('--gpu', help="GPU to use")
-
+parser.add_argument('--n-jobs', '-j', type=int, default=1,
+                    help="number of min/max and rerun fits trained concurrently (default: 1)")
+
+parser.add_argument('--replicas', action="store_true",
+                    help="train the min/max models of all reruns as stacked replicas in one pass")
+parser.add_argument('--n-shards', type=int, default=1,
+                    help="processes to shard each fit's configurations over (default: 1)")
+parser.add_argument('--native', action="store_true",
+                    help="train with the minimal native loop instead of a Lightning trainer")
+parser.add_argument('--exact-sampling', action="store_true",
+                    help="sample preset-graph data exactly from the joint table of the CTM")
+parser.add_argument('--counts', action="store_true",
+                    help="store data as a CountTable of configuration counts")
+parser.add_argument('--packed', action="store_true",
+                    help="train the models of all trials of a graph set in one packed loop")
 parser.add_argument('--n-resample-trials', '-r', type=int, default=1,
                     help="number of times the same trial is rerun (default: 1)")
 
@@ -65,6 +79,13 @@ if args.graph is not None:
         graph_set = {args.graph}
 
     for graph in graph_set:
+        if args.packed:
+            cg = CausalGraph.read("dat/cg/{}.cg".format(graph))
+            run_id_packed("{}/{}".format(args.name, graph),
+                          [(cg, graph, i) for i in range(args.n_trials)],
+                          args.n_samples, args.dim, args.n_epochs, args.n_resample_trials,
+                          exact_sampling=args.exact_sampling, counts=args.counts)
+            continue
         for i in range(args.n_trials):
             while True:
                 cg = CausalGraph.read("dat/cg/{}.cg".format(graph))
@@ -72,7 +93,10 @@ if args.graph is not None:
                 try:
                     graph_path = "{}/{}".format(args.name, graph)
                     if not run_id(graph_path, cg, cg_args, args.n_samples, args.dim, args.n_epochs, i,
-                                  args.n_resample_trials, gpu=gpu_used):
+                                  args.n_resample_trials, gpu=gpu_used, n_jobs=args.n_jobs,
+                                  replicas=args.replicas, native=args.native,
+                                  n_shards=args.n_shards, exact_sampling=args.exact_sampling,
+                                  counts=args.counts):
                         break
                 except Exception as e:
                     print(e)
@@ -87,6 +111,17 @@ else:
         "enf_bidir": args.enforce_bidir_path
     }
     for enf_ID in [False, True]:
+        if args.packed:
+            id_path = "{}/ID".format(args.name) if enf_ID else "{}/nonID".format(args.name)
+            graphs = [(sample_cg(args.n_vars, args.p_dir, args.p_bidir,
+                                 enforce_direct_path=args.enforce_dir_path,
+                                 enforce_bidirect_path=args.enforce_bidir_path, enforce_ID=enf_ID),
+                       cg_args, i)
+                      for i in range(args.n_trials)]
+            run_id_packed(id_path, graphs, args.n_samples, args.dim, args.n_epochs,
+                          args.n_resample_trials, exact_sampling=args.exact_sampling,
+                          counts=args.counts)
+            continue
         for i in range(args.n_trials):
             while True:
                 cg = sample_cg(args.n_vars, args.p_dir, args.p_bidir, enforce_direct_path=args.enforce_dir_path,
@@ -94,7 +129,10 @@ else:
                 try:
                     id_path = "{}/ID".format(args.name) if enf_ID else "{}/nonID".format(args.name)
                     if not run_id(id_path, cg, cg_args, args.n_samples, args.dim, args.n_epochs, i,
-                                  args.n_resample_trials, gpu=gpu_used):
+                                  args.n_resample_trials, gpu=gpu_used, n_jobs=args.n_jobs,
+                                  replicas=args.replicas, native=args.native,
+                                  n_shards=args.n_shards, exact_sampling=args.exact_sampling,
+                                  counts=args.counts):
                         break
                 except Exception as e:
                     print(e)
@@ -1,3 +1,6 @@
-from .metrics import all_metrics, all_metrics_minmax, probability_table, mad_metrics
+from .evaluator import AsyncEvaluator
+from .metrics import (all_metrics, all_metrics_minmax, probability_codes, probability_table,
+                      mad_metrics)
 
-__all__ = ['all_metrics', 'all_metrics_minmax', 'probability_table','mad_metrics']
+__all__ = ['AsyncEvaluator', 'all_metrics', 'all_metrics_minmax', 'probability_codes',
+           'probability_table', 'mad_metrics']
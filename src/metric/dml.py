@@ -7,10 +7,13 @@ import pandas as pd
 import torch as T
 from sklearn.model_selection import train_test_split
 
+from src.ds import CountTable
 from src.metric.xgb_util import XGBProb, CountingProb
 
 
 def dml_ate(dat, cg_file, use_xgb=False):
+    if isinstance(dat, CountTable):  # influence functions are averaged over samples
+        dat = dat.to_samples()
     df = pd.DataFrame({k: v.numpy().flatten() for k, v in dat.items()}).reset_index()
     df['*'] = 0
 
@@ -0,0 +1,101 @@
+import copy
+import threading
+
+import torch as T
+
+from .metrics import all_metrics
+
+
+def _graph_tensors(obj, found):
+    # tensors attached to an autograd graph (e.g. in caches), which copy.deepcopy refuses
+    if T.is_tensor(obj):
+        if obj.grad_fn is not None:
+            found.append(obj)
+    elif isinstance(obj, dict):
+        for v in obj.values():
+            _graph_tensors(v, found)
+    elif isinstance(obj, (list, tuple, set)):
+        for v in obj:
+            _graph_tensors(v, found)
+
+
+def snapshot(module):
+    """Deep copy of module without gradients, with tensors attached to a graph detached."""
+    found = []
+    for m in module.modules():
+        _graph_tensors([v for k, v in vars(m).items()
+                        if k not in ('_parameters', '_buffers', '_modules')], found)
+    memo = {id(t): t.detach().clone() for t in found}
+    return copy.deepcopy(module, memo).requires_grad_(False)
+
+
+class AsyncEvaluator:
+    """
+    Computes metrics of NCM snapshots off the training thread.
+
+    submit() copies the NCM (see snapshot) and returns at once; a background thread evaluates
+    the copy with all_metrics while training continues on the original, so neither waits for the
+    other or moves devices. If an evaluation is still running, the queued snapshot is replaced by the newer one,
+    so at most one is pending. results() returns the (step, epoch, metrics) of evaluations finished
+    since the last call, tagged with the step and epoch their snapshot was taken at. With
+    background=False, submit() evaluates in place instead.
+
+    Evaluations draw from the global torch RNG, so with background=True the interleaving with
+    training samples is not reproducible.
+    """
+
+    def __init__(self, truth, dat, cg_file, background=True):
+        self.truth = truth
+        self.dat = dat
+        self.cg_file = cg_file
+        self.background = background
+        self.pending = None
+        self.done = []
+        self.error = None
+        self.busy = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def _evaluate(self, ncm, n, step, epoch):
+        return step, epoch, all_metrics(self.truth, ncm, self.dat, self.cg_file, n=n)
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while self.pending is None:
+                    self.cond.wait()
+                job, self.pending = self.pending, None
+                self.busy = True
+            try:
+                result = self._evaluate(*job)
+            except Exception as e:
+                result = None
+                self.error = e
+            with self.cond:
+                if result is not None:
+                    self.done.append(result)
+                self.busy = False
+                self.cond.notify_all()
+
+    def submit(self, ncm, n, step, epoch):
+        ncm = snapshot(ncm)
+        if not self.background:
+            self.done.append(self._evaluate(ncm, n, step, epoch))
+            return
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, daemon=True)
+                self.thread.start()
+            self.pending = (ncm, n, step, epoch)
+            self.cond.notify_all()
+
+    def results(self, wait=False):
+        """Finished evaluations; with wait, first wait for the pending ones."""
+        with self.cond:
+            while wait and (self.pending is not None or self.busy):
+                self.cond.wait()
+            done, self.done = self.done, []
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return done
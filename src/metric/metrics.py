@@ -5,7 +5,9 @@ import numpy as np
 import pandas as pd
 import torch as T
 
+from src.ds import CountTable, ProbabilityTable
 from src.scm import CTM
+from src.scm.model_families import XORModel
 from src.metric.tv_nn import LikelihoodEstimator
 
 
@@ -24,13 +26,21 @@ def evaluating(net):
         net.to(device)
 
 
+def _weights(dat):
+    # each configuration of a CountTable stands for as many samples as its count
+    if isinstance(dat, CountTable):
+        return dat.counts[:, None].float()
+    v = next(iter(dat.values()))
+    return T.ones(len(v), 1, device=v.device)
+
+
 def ate(m, n=1000000, cuda=False):
     with evaluating(m):
         if cuda:
             m = m.cuda()
-        if isinstance(m, CTM):
-            return (m.pmf({'Y': 1}, do={'X': T.tensor([[1]], )})
-                    - m.pmf({'Y': 1}, do={'X': T.tensor([[0]])}))
+        if isinstance(m, (CTM, XORModel)):
+            return (m.table(do={'X': 1}, select=['Y'])[1]
+                    - m.table(do={'X': 0}, select=['Y'])[1]).item()
         else:
             y1 = m(n, do={'X': T.ones(n, 1)})['Y']
             y0 = m(n, do={'X': T.zeros(n, 1)})['Y']
@@ -38,61 +48,105 @@ def ate(m, n=1000000, cuda=False):
 
 
 def tv(m=None, dat=None, n=1000000):
-    if isinstance(m, CTM):
+    if isinstance(m, (CTM, XORModel)):
         with evaluating(m):
-            return (m.pmf({'Y': 1}, cond={'X': 1})
-                    - m.pmf({'Y': 1}, cond={'X': 0}))
+            pxy = m.table(select=['X', 'Y'])
+            return (pxy[1, 1] / pxy[1].sum() - pxy[0, 1] / pxy[0].sum()).item()
     else:
         if dat is None:
             with evaluating(m):
                 dat = m(n)
-        return (dat['Y'][dat['X'] == 1].float().mean()
-                - dat['Y'][dat['X'] == 0].float().mean()).item()
+        w = _weights(dat)
+        y = dat['Y'].float() * w
+        return (y[dat['X'] == 1].sum() / w[dat['X'] == 1].sum()
+                - y[dat['X'] == 0].sum() / w[dat['X'] == 0].sum()).item()
+
+
+def _wide_frame(dat):
+    # P(V) of samples too wide to code in one int64 (see CodedTable.max_bits), as a frame with one
+    # row per distinct configuration and each variable as an integer
+    cols = {}
+    for k, v in dat.items():
+        v = v.detach().long().cpu().reshape(len(v), -1)
+        cols[k] = (v * (1 << T.arange(v.shape[1] - 1, -1, -1))).sum(dim=1)
+    rows, counts = T.unique(T.stack(list(cols.values()), dim=1), dim=0, return_counts=True)
+    df = pd.DataFrame(rows.numpy(), columns=list(cols))
+    df['P(V)'] = (counts.double() / counts.sum()).numpy()
+    return df
+
+
+def _probabilities(m=None, n=1000000, do={}, dat=None):
+    # P(V) as a ProbabilityTable, or as a frame (see _wide_frame) if it cannot be coded
+    if isinstance(m, LikelihoodEstimator):
+        return _probabilities(dat=m(n=n))
+    if dat is None and not isinstance(m, (CTM, XORModel)):
+        with evaluating(m):
+            dat = m(n, do=do)
+    if (dat is not None and not isinstance(dat, CountTable)
+            and sum(v.reshape(len(v), -1).shape[1] for v in dat.values()) > CountTable.max_bits):
+        return _wide_frame(dat)
+    return probability_codes(m, n=n, do=do, dat=dat)
 
 
-def probability_table(m=None, n=1000000, do={}, dat=None):
-    if isinstance(m, CTM):
+def probability_codes(m=None, n=1000000, do={}, dat=None):
+    """P(V) as a ProbabilityTable of configuration codes aligned with their probabilities."""
+    if isinstance(m, CTM) and 2 ** len(m.v) <= m.max_table_size:
         with evaluating(m):
-            return pd.DataFrame.from_records([
-                {**v, 'P(V)': m.pmf(v, do=do)}
-                for v in m.space(tensor=False)
-            ])
+            do = {k: int(val) for k, val in do.items()}
+            pv = T.zeros((2,) * len(m.v), dtype=T.float64)
+            pv[tuple(do.get(k, slice(None)) for k in m.v)] = m.table(do=do).double()
+            return ProbabilityTable.from_dense({k: 1 for k in m.v}, pv)
+    elif isinstance(m, XORModel) and 2 ** sum(m.sizes[k] for k in m.v) <= m.max_table_size:
+        with evaluating(m):
+            return ProbabilityTable.from_dense({k: m.sizes[k] for k in m.v}, m.table(do=do),
+                                               drop_zeros=True)
     elif isinstance(m, LikelihoodEstimator):
-        dat = m(n=n)
-        return probability_table(n=n, dat=dat)
+        return probability_codes(dat=m(n=n))
+    elif isinstance(dat, CountTable):
+        return dat.probabilities()
     else:
         if dat is None:
             with evaluating(m):
                 dat = m(n, do=do)
-        else:
-            n = len(next(iter(dat.values())))
-        df = pd.DataFrame({k: v.detach().flatten().cpu().numpy()
-                           for k, v in dat.items()},
-                          index=range(n))
-        return (df.groupby(list(df.columns))
-                .apply(lambda x: len(x) / len(df))
-                .rename('P(V)').reset_index()
-                [[*df.columns, 'P(V)']])
+        return CountTable.from_samples(dat).probabilities()
 
 
-def kl(truth, ncm, n=1000000):
-    m_table = probability_table(ncm, n=n)
-    t_table = probability_table(truth, n=n)
+def probability_table(m=None, n=1000000, do={}, dat=None):
+    table = _probabilities(m, n=n, do=do, dat=dat)
+    return table if isinstance(table, pd.DataFrame) else table.to_frame()
+
+
+def _joined_frames(t_table, m_table, how, fill):
+    # fallback of kl and supremum_norm for tables that cannot be coded
+    t_table, m_table = (t if isinstance(t, pd.DataFrame) else t.to_frame()
+                        for t in (t_table, m_table))
     cols = list(t_table.columns[:-1])
-    joined_table = t_table.merge(m_table, how='left', on=cols, suffixes=['_t', '_m']).fillna(0.0000001)
-    p_t = joined_table['P(V)_t']
-    p_m = joined_table['P(V)_m']
-    return (p_t * (np.log(p_t) - np.log(p_m))).sum()
+    joined = t_table.merge(m_table, how=how, on=cols, suffixes=['_t', '_m']).fillna(fill)
+    return joined['P(V)_t'], joined['P(V)_m']
+
+
+def kl(truth, ncm, n=1000000):
+    t_table = _probabilities(truth, n=n)
+    m_table = _probabilities(ncm, n=n)
+    if isinstance(t_table, pd.DataFrame) or isinstance(m_table, pd.DataFrame):
+        p_t, p_m = _joined_frames(t_table, m_table, 'left', 0.0000001)
+        p_t, p_m = p_t[p_t > 0], p_m[p_t > 0]
+        return float((p_t * (np.log(p_t) - np.log(p_m))).sum())
+    m_table = m_table.reorder(t_table.sizes)
+    p_t = t_table.probs[t_table.probs > 0]
+    p_m = m_table.lookup(t_table.codes[t_table.probs > 0], default=0.0000001)
+    return (p_t * (T.log(p_t) - T.log(p_m))).sum().item()
 
 
 def supremum_norm(truth, ncm, n=1000000):
-    m_table = probability_table(ncm, n=n)
-    t_table = probability_table(truth, n=n)
-    cols = list(t_table.columns[:-1])
-    joined_table = t_table.merge(m_table, how='outer', on=cols, suffixes=['_t', '_m']).fillna(0.0)
-    p_t = joined_table['P(V)_t']
-    p_m = joined_table['P(V)_m']
-    return (p_m - p_t).abs().max()
+    t_table = _probabilities(truth, n=n)
+    m_table = _probabilities(ncm, n=n)
+    if isinstance(t_table, pd.DataFrame) or isinstance(m_table, pd.DataFrame):
+        p_t, p_m = _joined_frames(t_table, m_table, 'outer', 0.0)
+        return float((p_m - p_t).abs().max())
+    m_table = m_table.reorder(t_table.sizes)
+    codes = T.cat((t_table.codes, m_table.codes)).unique()
+    return (m_table.lookup(codes) - t_table.lookup(codes)).abs().max().item()
 
 
 def plugin_ate(dat, cg_file):
@@ -100,34 +154,30 @@ def plugin_ate(dat, cg_file):
         return float('nan')
     graph = cg_file.split('/')[-1].split('.')[0]
     def diff(g): return (-next(g) + next(g)).item()
+    wt = _weights(dat)
+    def mean(x, mask=True): return (x.float() * wt * mask).sum() / (wt * mask).sum()
     if graph == 'backdoor':
         return diff(
-            sum(dat['Y'][(dat['Z'] == z)
-                         & (dat['X'] == x)].float().mean()
-                * (dat['Z'] == z).float().mean()
+            sum(mean(dat['Y'], (dat['Z'] == z) & (dat['X'] == x))
+                * mean(dat['Z'] == z)
                 for z in (0, 1))
             for x in (0, 1))
     elif graph == 'frontdoor':
         return diff(
-            sum((dat['M'][dat['X'] == x] == m).float().mean()
-                * sum(dat['Y'][(dat['X'] == xp)
-                               & (dat['M'] == m)].float().mean()
-                      * (dat['X'] == xp).float().mean()
+            sum(mean(dat['M'] == m, dat['X'] == x)
+                * sum(mean(dat['Y'], (dat['X'] == xp) & (dat['M'] == m))
+                      * mean(dat['X'] == xp)
                       for xp in (0, 1))
                 for m in (0, 1))
             for x in (0, 1))
     elif graph == 'napkin':
         return diff(
-            sum(sum((((dat['X'] == x)
-                      & (dat['Y'] == 1))
-                     [(dat['W'] == w)
-                      & (dat['Z'] == z)]).float().mean()
-                    * (dat['W'] == w).float().mean()
+            sum(sum(mean((dat['X'] == x) & (dat['Y'] == 1),
+                         (dat['W'] == w) & (dat['Z'] == z))
+                    * mean(dat['W'] == w)
                     for w in (0, 1))
-                / sum(((dat['X'] == x)
-                       [(dat['W'] == w)
-                        & (dat['Z'] == z)]).float().mean()
-                      * (dat['W'] == w).float().mean()
+                / sum(mean(dat['X'] == x, (dat['W'] == w) & (dat['Z'] == z))
+                      * mean(dat['W'] == w)
                       for w in (0, 1))
                 for z in (0, 1)) / 2
             for x in (0, 1))
@@ -142,12 +192,10 @@ def interventional_distribution_error(truth, ncm, n=1000000):
 
     # 只采样一次 do(X=0) 和 do(X=1)
     def get_probs(model):
-        if isinstance(model, CTM):
+        if isinstance(model, (CTM, XORModel)):
             with evaluating(model):
-                return [
-                    [model.pmf({'Y': y_val}, do={'X': T.tensor([[x_val]])}) for y_val in (0, 1)]
-                    for x_val in (0, 1)
-                ]
+                return [model.table(do={'X': x_val}, select=['Y']).tolist()
+                        for x_val in (0, 1)]
         else:
             with evaluating(model):
                 samples0 = model(n, do={'X': T.zeros(n, 1)})
@@ -182,8 +230,7 @@ def all_metrics(truth, ncm, dat, cg_file, n=1000000):
         supremum_norm=supremum_norm(truth, ncm, n=n),
         plugin_ate=plugin_ate(dat, cg_file),
         interventional_distribution_error=interventional_distribution_error(truth, ncm, n=n))
-    m['dat_tv'] = (dat['Y'][dat['X'] == 1].float().mean()
-                   - dat['Y'][dat['X'] == 0].float().mean()).item()
+    m['dat_tv'] = tv(dat=dat)
 
     m['err_ncm_ate'] = m['true_ate'] - m['ncm_ate']
     m['err_plugin_ate'] = m['true_ate'] - m['plugin_ate']
@@ -211,8 +258,7 @@ def all_metrics_minmax(truth, ncm_min, ncm_max, dat, cg_file, n=1000000):
         supremum_norm_min=supremum_norm(truth, ncm_min, n=n),
         supremum_norm_max=supremum_norm(truth, ncm_max, n=n),
         plugin_ate=plugin_ate(dat, cg_file))
-    m['dat_tv'] = (dat['Y'][dat['X'] == 1].float().mean()
-                   - dat['Y'][dat['X'] == 0].float().mean()).item()
+    m['dat_tv'] = tv(dat=dat)
 
     m['err_ncm_min_ate'] = m['true_ate'] - m['ncm_min_ate']
     m['err_ncm_max_ate'] = m['true_ate'] - m['ncm_max_ate']
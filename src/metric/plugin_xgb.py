@@ -2,10 +2,13 @@ import sys
 import numpy as np
 import torch as T
 import pandas as pd
+from src.ds import CountTable
 from src.metric.xgb_util import XGBProb, CountingProb
 
 
 def plugin_xgb_ate(dat, cg_file):
+    if isinstance(dat, CountTable):  # the models are fit on individual samples
+        dat = dat.to_samples()
     df = pd.DataFrame({k: v.numpy().flatten() for k, v in dat.items()}).reset_index()
     df['*'] = 0
     graph = cg_file.split('/')[-1].split('.')[0]
@@ -9,6 +9,7 @@ from sklearn.model_selection import train_test_split
 from tqdm.auto import tqdm
 from xgboost import XGBRegressor
 
+from src.ds import CountTable
 from .metrics import tv
 
 
@@ -60,6 +61,8 @@ def werm(trX, teX, y, w, lambda_h, binary=True, timer=None):
 
 
 def werm_ate(dat, cg_file, n=100000, regvals=None, skip_train=False):
+    if isinstance(dat, CountTable):  # the weight models are fit on individual samples
+        dat = dat.to_samples()
     df = pd.DataFrame({k: (v * (1 << np.arange(v.shape[-1]))).sum(dim=1) for k, v in dat.items()})
     df['*'] = 0
     df_full = pd.DataFrame({f'{k}{i}': v[:, i].numpy()
@@ -1,12 +1,29 @@
+import random
+
+import numpy as np
 import pytorch_lightning as pl
 import torch as T
-from torch.utils.data import DataLoader, Dataset
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+
+from src import metric
+from src.ds import CountTable
 
 
 class BasePipeline(pl.LightningModule):
     min_delta = 1e-6
     patience = 20
     max_epochs = 10000
+    chunk_size = None  # U samples per chunk in likelihood estimates; None evaluates all at once
+    bf16 = False  # run NCM mechanisms under bfloat16 autocast
+    sparse = None  # fit only the observed support; None: if the space exceeds max_space_size
+    max_space_size = 2 ** 16
+    minibatch = False  # fit the configurations of a minibatch of data rows per step
+    batch_size = 4096
+    async_metrics = True  # evaluate training metrics on NCM snapshots in a background thread
+    state_attrs = ()  # training state outside the parameters, saved with checkpoints for resuming
+    seen_mass = None  # sparse mode: NCM probability of the observed support in the last step
+    objective_attrs = ('sparse', 'chunk_size', 'bf16', 'minibatch')  # hyperparameters of objective
 
     def __init__(self, ctm, dat, cg_file, ncm):
         super().__init__()
@@ -14,23 +31,275 @@ class BasePipeline(pl.LightningModule):
         self.dat = dat
         self.cg_file = cg_file
         self.ncm = ncm
+        self.native = None  # src.run.pipeline.NativeTrainer driving training_step, if any
+        self.evaluator = None
+
+    # without a pl.Trainer, the Lightning calls in training_step are served by the native trainer
+    @property
+    def current_epoch(self):
+        return self.native.current_epoch if self.native is not None else super().current_epoch
+
+    @property
+    def global_step(self):
+        return self.native.global_step if self.native is not None else super().global_step
+
+    @property
+    def logger(self):
+        return self.native.logger if self.native is not None else super().logger
+
+    def optimizers(self, use_pl_optimizer=True):
+        if self.native is not None:
+            return self.native.optimizer
+        return super().optimizers(use_pl_optimizer)
+
+    def manual_backward(self, loss, *args, **kwargs):
+        if self.native is not None:
+            loss.backward()
+        else:
+            super().manual_backward(loss, *args, **kwargs)
+
+    def log(self, name, value, *args, **kwargs):
+        if self.native is not None:
+            self.native.log(name, value)
+        else:
+            super().log(name, value, *args, **kwargs)
 
     def forward(self, n=1, u=None, do={}):
         return self.ncm(n, u, do)
 
+    def mechanism_autocast(self):
+        # only the MADE matmuls are cast; Simple keeps the likelihood path in float32
+        return T.autocast(device_type=self.device.type, dtype=T.bfloat16, enabled=self.bf16)
+
+    def target_nlpvs(self):
+        # -log P(v) in the data for every configuration of ncm.space(), in order (0 if unobserved),
+        # looked up by configuration code
+        sizes = {k: 1 for k in self.ncm.v}
+        pv = (metric.probability_codes(dat=self.dat).reorder(sizes)
+              .lookup(T.arange(2 ** len(sizes)), default=1.))
+        return -T.log(pv).float()
+
+    def init_targets(self):
+        # configurations to fit and -log P(v) in the data for each, in matching order
+        if self.minibatch:  # drawn per step by batch_targets
+            self.sparse = False
+            self.support = self.nlpvs = None
+            self.unseen_mass = 0.
+            return
+        if self.sparse is None:
+            self.sparse = 2 ** len(self.ncm.v) > self.max_space_size
+        if not self.sparse:
+            self.support = None
+            self.unseen_mass = 0.
+            self.nlpvs = self.target_nlpvs()
+            return
+
+        # distinct observed configurations of ncm.v and their counts
+        rows = T.cat([self.dat[k].detach().long().cpu().reshape(-1, 1) for k in self.ncm.v], dim=1)
+        if isinstance(self.dat, CountTable):
+            counts = self.dat.counts
+        else:
+            rows, counts = T.unique(rows, dim=0, return_counts=True)
+        n = counts.sum().item()
+
+        # Good-Turing estimate of the mass of configurations missing from the data
+        self.unseen_mass = (counts == 1).sum().item() / n
+        self.support = [{k: rows[i:i + 1, j:j + 1] for j, k in enumerate(self.ncm.v)}
+                        for i in range(len(rows))]
+        self.nlpvs = -T.log((1 - self.unseen_mass) * counts.double() / n).float()
+
+    def configurations(self):
+        if not self.sparse:
+            return list(self.ncm.space())
+        if self.support[0][self.ncm.v[0]].device != self.device:
+            self.support = [{k: val.to(self.device) for k, val in v.items()} for v in self.support]
+        return self.support
+
+    def batch_targets(self, batch):
+        # distinct configurations in a minibatch of rows, with -log of their frequency in it; the
+        # loss over them is an unbiased estimate of the full objective up to a constant
+        rows = T.cat([batch[k].long().reshape(len(batch[k]), -1) for k in self.ncm.v], dim=1)
+        rows, counts = T.unique(rows, dim=0, return_counts=True)
+        space = [{k: rows[i:i + 1, j:j + 1] for j, k in enumerate(self.ncm.v)}
+                 for i in range(len(rows))]
+        return space, -T.log(counts.float() / counts.sum())
+
+    def step_targets(self, batch):
+        rank, world_size = self.shard()
+        if self.minibatch:
+            assert world_size == 1, 'minibatches are not sharded'
+            return self.batch_targets(batch)
+        if world_size > 1:
+            return self.configurations()[rank::world_size], self.nlpvs[rank::world_size]
+        return self.configurations(), self.nlpvs
+
+    def shard(self):
+        # (rank, world size) when the configurations are sharded over torch.distributed processes
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    def is_lead(self):
+        # terms outside the per-configuration sum, and logging, belong to rank 0 only
+        return self.shard()[0] == 0
+
+    def all_reduce(self, x):
+        # sum of a float or tensor over the shards
+        if self.shard()[1] == 1:
+            return x
+        t = x.detach().clone() if T.is_tensor(x) else T.tensor(x, dtype=T.float64)
+        dist.all_reduce(t)
+        return t if T.is_tensor(x) else t.item()
+
+    def sync_gradients(self):
+        # sum the gradients of all shards before opt.step(), as if computed in one process
+        if self.shard()[1] == 1:
+            return
+        params = list(self.ncm.parameters())
+        for p in params:
+            if p.grad is None:
+                p.grad = T.zeros_like(p)
+        flat = self.all_reduce(T.cat([p.grad.flatten() for p in params]))
+        for p, g in zip(params, flat.split([p.numel() for p in params])):
+            p.grad.copy_(g.view_as(p))
+
+    def unseen_loss(self, nlls):
+        # KL term for the unseen configurations as a whole: the NCM should leave them unseen_mass
+        if not self.unseen_mass:
+            return T.zeros((), device=self.device)
+        seen = T.exp(-T.stack([nll.reshape(()) for nll in nlls])).sum()
+        # when sharded, the value is that of all shards and the gradient that of this shard's
+        seen = seen + (self.all_reduce(seen) - seen).detach()
+        return self.unseen_mass * (T.log(T.tensor(self.unseen_mass, device=self.device))
+                                   - T.log(T.clamp(1 - seen, min=1e-6)))
+
+    def backward_target(self, loss, nll, *args, weight=1.):
+        # back-propagate weight * loss of one configuration right away, so that only its graph is
+        # held; in sparse mode, add its share of the gradient of unseen_loss, unseen_mass / (1 - S)
+        # times that of exp(-nll), with S the seen mass of the previous step (its target
+        # 1 - unseen_mass in the first)
+        if self.sparse and self.unseen_mass:
+            seen = 1 - self.unseen_mass if self.seen_mass is None else self.seen_mass
+            loss = loss + self.unseen_mass / max(1 - seen, 1e-6) * T.exp(-nll.reshape(()))
+        self.manual_backward(weight * loss, *args)
+
+    def unseen_value(self, nlls):
+        # sparse mode, after backward_target of the step's configurations: record their seen mass
+        # (over all shards) from the nll values and return the value of unseen_loss on the lead
+        self.seen_mass = self.all_reduce(float(sum(np.exp(-nll) for nll in nlls)))
+        if not self.unseen_mass or not self.is_lead():
+            return 0.
+        return self.unseen_mass * (np.log(self.unseen_mass) - np.log(max(1 - self.seen_mass, 1e-6)))
+
+    def evaluate_metrics(self, n):
+        # metric.all_metrics of the NCM as of this step, reported later by log_evaluations
+        if not self.is_lead():
+            return
+        if self.evaluator is None:
+            self.evaluator = metric.AsyncEvaluator(self.ctm, self.dat, self.cg_file,
+                                                   background=self.async_metrics)
+        self.evaluator.submit(self.ncm, n, self.global_step, self.current_epoch)
+
+    def log_evaluations(self, prefix='', wait=False):
+        # log finished evaluations at the step their snapshot was taken; return (epoch, results)
+        if self.evaluator is None:
+            return []
+        evaluations = []
+        for step, epoch, results in self.evaluator.results(wait=wait):
+            if self.logger is not None:
+                self.logger.log_metrics({prefix + k: v for k, v in results.items()}, step=step)
+            evaluations.append((epoch, results))
+        return evaluations
+
+    def on_save_checkpoint(self, checkpoint):
+        # with the optimizer, scheduler, loop and callback states saved by Lightning, enough to
+        # resume training where it left off
+        checkpoint['pipeline_state'] = {k: getattr(self, k) for k in self.state_attrs}
+        checkpoint['rng_states'] = {
+            'torch': T.get_rng_state(),
+            'cuda': T.cuda.get_rng_state_all() if T.cuda.is_available() else [],
+            'numpy': np.random.get_state(),
+            'python': random.getstate(),
+        }
+
+    def on_load_checkpoint(self, checkpoint):
+        for k, v in checkpoint.get('pipeline_state', {}).items():
+            setattr(self, k, v)
+        rng = checkpoint.get('rng_states')
+        if rng is not None:
+            T.set_rng_state(rng['torch'])
+            if rng['cuda'] and T.cuda.is_available():
+                T.cuda.set_rng_state_all(rng['cuda'])
+            np.random.set_state(rng['numpy'])
+            random.setstate(rng['python'])
+            rank, world_size = self.shard()
+            if world_size > 1:
+                # every shard loads the RNG states of rank 0; derive a distinct seed for each
+                seed = (int(T.randint(2 ** 31, ())) + rank) & 0xffffffff
+                T.manual_seed(seed)
+                np.random.seed(seed)
+                random.seed(seed)
+
+    def on_train_end(self):
+        self.log_evaluations(self.metric_prefix(), wait=True)
+
+    def metric_prefix(self):
+        return ''
+
     def train_dataloader(self):  # 1 epoch = 1 step
-        return T.utils.data.DataLoader(
-            SCMDataset(self.dat),
-            batch_size=4096,
-            num_workers=8,
-            shuffle=True,
-            pin_memory=True
-            )
-    
+        # batches are already collated, so the loader only passes them through, in process
+        return DataLoader(TensorBatchDataset(self.dat, self.batch_size), batch_size=None)
+
+
+class TensorBatchDataset(IterableDataset):
+    """
+    Minibatches of data rows as dicts of column tensors, without per-row indexing.
+
+    Each pass draws a new shuffle: row data is permuted once into contiguous columns, and batches
+    are slices of them. For a CountTable, each batch maps a block of the shuffled row indices to
+    configurations through the cumulative counts.
+    """
+
+    def __init__(self, dat, batch_size, shuffle=True):
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.offsets = None
+        if isinstance(dat, CountTable):
+            self.columns = dict(dat.items())
+            self.offsets = dat.counts.cumsum(0)
+            self.n = dat.n
+        elif hasattr(dat, 'iloc'):
+            self.columns = {k: T.as_tensor(dat[k].values).reshape(len(dat), -1)
+                            for k in dat.columns}
+            self.n = len(dat)
+        else:
+            self.columns = dict(dat)
+            self.n = len(next(iter(dat.values())))
+
+    def __len__(self):
+        return -(-self.n // self.batch_size)
+
+    def __iter__(self):
+        order = T.randperm(self.n) if self.shuffle else T.arange(self.n)
+        if self.offsets is None:
+            columns = {k: v[order.to(v.device)] for k, v in self.columns.items()}
+            for i in range(0, self.n, self.batch_size):
+                yield {k: v[i:i + self.batch_size] for k, v in columns.items()}
+        else:
+            for i in range(0, self.n, self.batch_size):
+                j = T.searchsorted(self.offsets, order[i:i + self.batch_size], right=True)
+                yield {k: v[j] for k, v in self.columns.items()}
+
+
 class SCMDataset(Dataset):
     def __init__(self, dat_sets):
         # 支持 DataFrame 或 dict
-        if hasattr(dat_sets, 'shape'):
+        if isinstance(dat_sets, CountTable):
+            # sample i is the configuration whose cumulative count first exceeds i
+            self.length = dat_sets.n
+            self.data = dat_sets
+            self.offsets = dat_sets.counts.cumsum(0)
+        elif hasattr(dat_sets, 'shape'):
             self.length = dat_sets.shape[0]
             self.data = dat_sets
         else:
@@ -42,7 +311,10 @@ class SCMDataset(Dataset):
         return self.length
 
     def __getitem__(self, idx):
-        if hasattr(self.data, 'iloc'):
+        if isinstance(self.data, CountTable):
+            j = T.searchsorted(self.offsets, T.tensor(idx), right=True)
+            return {k: v[j] for k, v in self.data.items()}
+        elif hasattr(self.data, 'iloc'):
             # DataFrame
             return {k: self.data.iloc[idx][k] for k in self.data.columns}
         else:
@@ -17,15 +17,7 @@ class BiasedNLLNCMPipeline(BasePipeline):
         super().__init__(ctm, dat, cg_file, ncm)
 
         self.automatic_optimization = False
-        self.nlpv = metric.probability_table(dat=dat)
-        self.nlpv['_nlpv'] = -np.log(self.nlpv['P(V)'].astype(np.float32))
-
-        space = list(self.ncm.space())
-        self.nlpvs = [T.tensor(
-            (lambda x: 0 if len(x) == 0 else x.item())
-            (self.nlpv.query(' and '.join(f'{k} == {val.item()}'
-                                          for k, val in v.items()))._nlpv)).float()
-                      for v in space]
+        self.init_targets()
 
     def forward(self, n=1000, u=None, do={}):
         assert u.is_cuda, "Input tensor is not on GPU"
@@ -45,13 +37,27 @@ class BiasedNLLNCMPipeline(BasePipeline):
             }
         }
 
+    def objective(self, epoch, batch=None, n=int(10 ** 3)):
+        # the loss of training_step as one differentiable tensor (see NLLNCMMaxPipeline.objective)
+        space, nlpvs = self.step_targets(batch)
+        loss = 0
+        nlls = []
+        for v, nlpv in zip(space, nlpvs):
+            with self.mechanism_autocast():
+                nll = self.ncm.biased_nll(v, n=n, chunk_size=self.chunk_size)
+            loss = loss + T.exp(-nlpv) * (nll - nlpv)
+            nlls.append(nll)
+        if self.sparse:
+            loss = loss + self.unseen_loss(nlls)
+        return loss
+
     def training_step(self, batch, batch_idx):
         opt = self.optimizers()  # 获取优化器
         n = int(10 ** 3)
         loss_agg = 0
         nll_agg = []
         nlpv_agg = []
-        space = list(self.ncm.space())
+        space, nlpvs = self.step_targets(batch)
         """
         nlpvs = [T.tensor(
             (lambda x: 0 if len(x) == 0 else x.item())
@@ -60,14 +66,19 @@ class BiasedNLLNCMPipeline(BasePipeline):
             for v in space]
         """
         opt.zero_grad()
-        for v, nlpv in zip(space, self.nlpvs):
-            nll = self.ncm.biased_nll(v, n=n)
+        for v, nlpv in zip(space, nlpvs):
+            with self.mechanism_autocast():
+                nll = self.ncm.biased_nll(v, n=n, chunk_size=self.chunk_size)
             loss = T.exp(-nlpv) * (nll - nlpv)
-            self.manual_backward(loss)
+            self.backward_target(loss, nll)
             nll_agg.append(nll.item())
             nlpv_agg.append(nlpv.item())
             loss_agg += loss.item()
             del nll, loss
+        if self.sparse:
+            loss_agg += self.unseen_value(nll_agg)
+        self.sync_gradients()
+        loss_agg = self.all_reduce(loss_agg)
         opt.step()
         self.log('train_loss', loss_agg, prog_bar=True)
         self.log('lr', opt.param_groups[0]['lr'], prog_bar=True)
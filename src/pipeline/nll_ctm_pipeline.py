@@ -16,8 +16,7 @@ class NLLCTMPipeline(BasePipeline):
         super().__init__(ctm, dat, cg_file, ncm)
 
         self.automatic_optimization = False
-        self.nlpv = metric.probability_table(dat=dat)
-        self.nlpv['_nlpv'] = -np.log(self.nlpv['P(V)'].astype(np.float32))
+        self.nlpvs = self.target_nlpvs()
 
     def forward(self, n=1000, u=None, do={}):
         return self.ncm(n, u, do)
@@ -34,23 +33,16 @@ class NLLCTMPipeline(BasePipeline):
 
     def training_step(self, batch, batch_idx):
         opt = self.optimizers()
-        loss_agg = 0
-        nll_agg = []
-        nlpv_agg = []
-        space = list(self.ncm.space())
-        nlpvs = [T.tensor(self.nlpv.query(
-            ' and '.join(f'{k} == {val.item()}'
-                         for k, val in v.items()))._nlpv.item())
-                 for v in space]
         opt.zero_grad()
-        for v, nlpv in zip(space, nlpvs):
-            nll = -self.ncm.log_pmf(v)
-            loss = T.exp(-nlpv) * (nll - nlpv)
-            self.manual_backward(loss, opt)
-            nll_agg.append(nll.item())
-            nlpv_agg.append(nlpv.item())
-            loss_agg += loss.item()
-            del nll, loss
+        # the flattened joint table lines up with space
+        nll = -T.log(self.ncm.table().flatten())
+        nlpv = self.nlpvs.to(nll.device)
+        loss = (T.exp(-nlpv) * (nll - nlpv)).sum()
+        self.manual_backward(loss, opt)
+        nll_agg = nll.tolist()
+        nlpv_agg = nlpv.tolist()
+        loss_agg = loss.item()
+        del nll, nlpv, loss
         opt.step()
         self.log('train_loss', loss_agg, prog_bar=True)
         self.log('lr', opt.param_groups[0]['lr'], prog_bar=True)
@@ -66,8 +58,6 @@ class NLLCTMPipeline(BasePipeline):
                     T.exp(-nlpv) * (nll - nlpv)
                 ], dim=-1).numpy()
                 print(pd.DataFrame(arr, columns=['P*(V)', 'P(V)', 'loss']))
-            results = metric.all_metrics(self.ctm, self.ncm, self.dat,
-                                         self.cg_file, n=10000)
+            self.evaluate_metrics(10000)
+        for epoch, results in self.log_evaluations():
             print(pd.Series(results))
-            for k, v in results.items():
-                self.log(k, v)
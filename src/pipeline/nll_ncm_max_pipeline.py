@@ -11,8 +11,13 @@ from src.scm import NCM
 class NLLNCMMaxPipeline(BasePipeline):
     patience = 200
     biased = False
+    state_attrs = ('n',)  # the max_reg schedule follows current_epoch, which Lightning restores
+    objective_attrs = BasePipeline.objective_attrs + (
+        'max_reg_upper', 'max_reg_lower', 'total_iters', 'n', 'biased')
 
-    def __init__(self, ctm, dat, cg_file, maximize=True, max_reg_upper=0.1, max_reg_lower=0.001, total_iters=1000):
+    def __init__(self, ctm, dat, cg_file, maximize=True, max_reg_upper=0.1, max_reg_lower=0.001,
+                 total_iters=1000, n_samples=int(2 * 10 ** 4), adaptive_n=False, n_start=1000,
+                 n_growth=2, norm_test=1.0, n_test_every=10, n_test_groups=4):
         if isinstance(cg_file, str):
             parsed_cg = CausalGraph.read(cg_file)
         elif isinstance(cg_file, CausalGraph):
@@ -23,8 +28,6 @@ class NLLNCMMaxPipeline(BasePipeline):
         super().__init__(ctm, dat, parsed_cg, ncm)
 
         self.automatic_optimization = False
-        self.nlpv = metric.probability_table(dat=dat)
-        self.nlpv['_nlpv'] = -np.log(self.nlpv['P(V)'].astype(np.float32))
 
         self.maximize = maximize
         self.max_reg_upper = max_reg_upper
@@ -32,12 +35,23 @@ class NLLNCMMaxPipeline(BasePipeline):
         self.total_iters = total_iters
         self.max_reg = 1.0
 
-        space = list(self.ncm.space())
-        self.nlpvs = [T.tensor(
-            (lambda x: 0 if len(x) == 0 else x.item())
-            (self.nlpv.query(' and '.join(f'{k} == {val.item()}'
-                                          for k, val in v.items()))._nlpv)).float()
-                      for v in space]
+        # U samples per likelihood estimate; with adaptive_n, n starts at n_start and grows by
+        # n_growth (up to n_samples) whenever a norm test every n_test_every epochs fails
+        self.n_samples = n_samples
+        self.adaptive_n = adaptive_n
+        self.n = min(n_start, n_samples) if adaptive_n else n_samples
+        self.n_growth = n_growth
+        self.norm_test = norm_test
+        self.n_test_every = n_test_every
+        self.n_test_groups = n_test_groups
+
+        # ate_loss marginalizes P(y | do(x)) over every configuration of the other variables, so
+        # unlike the data term (see sparse and minibatch), its cost grows as 2 ** (|V| - 2)
+        if 2 ** (len(ncm.v) - 2) > self.max_space_size:
+            raise ValueError('the ATE term would enumerate 2 ** %d configurations per step'
+                             % (len(ncm.v) - 2))
+
+        self.init_targets()
 
     def forward(self, n=1000, u=None, do={}):
         return self.ncm(n, u, do)
@@ -52,49 +66,54 @@ class NLLNCMMaxPipeline(BasePipeline):
 
     def training_step(self, batch, batch_idx):
         opt = self.optimizers()
-        n = int(2 * 10 ** 4)
-        reg_ratio = min(self.current_epoch, self.total_iters) / self.total_iters
-        reg_up = np.log(self.max_reg_upper)
-        reg_low = np.log(self.max_reg_lower)
-        max_reg = np.exp(reg_up - reg_ratio * (reg_up - reg_low))
+        if (self.adaptive_n and self.n < self.n_samples and batch_idx == 0
+                and self.current_epoch % self.n_test_every == 0):
+            self.grow_n(batch)
+        n = self.n
+        max_reg = self.max_reg_at(self.current_epoch)
 
         loss_agg = 0
         nll_agg = []
         nlpv_agg = []
-        space = list(self.ncm.space())
+        space, nlpvs = self.step_targets(batch)
         opt.zero_grad()
-        for v, nlpv in zip(space, self.nlpvs):
+        for v, nlpv in zip(space, nlpvs):
             # _, nll = self.ncm.nll(v, m=n, return_biased=self.biased)
-            nll = self.ncm.biased_nll(v, n=n)
+            with self.mechanism_autocast():
+                nll = self.ncm.biased_nll(v, n=n, chunk_size=self.chunk_size)
             loss = T.exp(-nlpv) * (nll - nlpv)
-            self.manual_backward(loss, opt)
+            self.backward_target(loss, nll, opt)
             nll_agg.append(nll.item())
             nlpv_agg.append(nlpv.item())
             loss_agg += loss.item()
             del nll, loss
+        if self.sparse:
+            loss_agg += self.unseen_value(nll_agg)
         # print("\nNLL Loss: {}".format(loss_agg))
-        max_loss = max_reg * self.ate_loss(n)
-        # print("Max Reg: {}".format(max_reg))
-        # print("Max Loss: {}".format(max_loss.item()))
-        self.manual_backward(max_loss, opt)
-        loss_agg += max_loss.item()
-        del max_loss
+        if self.is_lead():
+            with self.mechanism_autocast():
+                max_loss = max_reg * self.ate_loss(n)
+            # print("Max Reg: {}".format(max_reg))
+            # print("Max Loss: {}".format(max_loss.item()))
+            self.manual_backward(max_loss, opt)
+            loss_agg += max_loss.item()
+            del max_loss
         # T.nn.utils.clip_grad_norm_(self.ncm.parameters(), 1e-7)
+        self.sync_gradients()
+        loss_agg = self.all_reduce(loss_agg)
         opt.step()
         self.log('train_loss', loss_agg, prog_bar=True)
         self.log('lr', opt.param_groups[0]['lr'], prog_bar=True)
+        self.log('n_samples', float(n))
 
         # logging
         if (self.current_epoch + 1) % 10 == 0:
-            results = metric.all_metrics(self.ctm, self.ncm, self.dat,
-                                         self.cg_file, n=n)
-            for k, v in results.items():
-                if self.maximize:
-                    self.log("max_" + k, v)
-                else:
-                    self.log("min_" + k, v)
-
-        if (self.current_epoch + 1) % 50 == 0:
+            self.evaluate_metrics(self.n_samples)
+        for epoch, results in self.log_evaluations(self.metric_prefix()):
+            if (epoch + 1) % 50 == 0:
+                print(pd.Series(results))
+
+        if (self.current_epoch + 1) % 50 == 0 and self.is_lead():
             with T.no_grad():
                 nlpv = T.tensor(nlpv_agg)
                 nll = T.tensor(nll_agg)
@@ -104,55 +123,107 @@ class NLLNCMMaxPipeline(BasePipeline):
                     T.exp(-nlpv) * (nll - nlpv)
                 ], dim=-1).numpy()
                 print(pd.DataFrame(arr, columns=['P*(V)', 'P(V)', 'loss']))
-            print(pd.Series(results))
+
+    def metric_prefix(self):
+        return 'max_' if self.maximize else 'min_'
+
+    def max_reg_at(self, epoch):
+        reg_ratio = min(epoch, self.total_iters) / self.total_iters
+        reg_up = np.log(self.max_reg_upper)
+        reg_low = np.log(self.max_reg_lower)
+        return np.exp(reg_up - reg_ratio * (reg_up - reg_low))
+
+    def objective(self, epoch, batch=None, n=None):
+        # the loss of training_step as one differentiable tensor, free of .item() and
+        # data-dependent branches so that it can be vmapped over replicas (see src.run.replica)
+        n = self.n if n is None else n
+        space, nlpvs = self.step_targets(batch)
+        loss = 0
+        nlls = []
+        for v, nlpv in zip(space, nlpvs):
+            with self.mechanism_autocast():
+                nll = self.ncm.biased_nll(v, n=n, chunk_size=self.chunk_size)
+            loss = loss + T.exp(-nlpv) * (nll - nlpv)
+            nlls.append(nll)
+        if self.sparse:
+            loss = loss + self.unseen_loss(nlls)
+        if self.is_lead():
+            with self.mechanism_autocast():
+                loss = loss + self.max_reg_at(epoch) * self.ate_loss(n)
+        return loss
+
+    def grow_n(self, batch):
+        # norm test: from n_test_groups independent gradients of n / n_test_groups U samples each,
+        # estimate the variance of the gradient with n samples; grow n while it exceeds
+        # norm_test ** 2 times the squared norm of the mean gradient
+        params = list(self.ncm.parameters())
+        k = self.n_test_groups
+        grads = []
+        for _ in range(k):
+            loss = self.objective(self.current_epoch, batch, n=max(1, self.n // k)).sum()
+            g = T.autograd.grad(loss, params, allow_unused=True)
+            grads.append(T.cat([(T.zeros_like(p) if gi is None else gi).flatten().float()
+                                for p, gi in zip(params, g)]))
+        grads = self.all_reduce(T.stack(grads))
+        var = grads.var(dim=0).sum() / k
+        if var > self.norm_test ** 2 * grads.mean(dim=0).pow(2).sum():
+            self.n = min(int(self.n * self.n_growth), self.n_samples)
 
     def precision_check(self, val):
         return T.relu(val) + 0.000001
 
     def ate_loss(self, n=1000000):
         y0_do0 = T.exp(-self.ncm.nll_marg({'Y': T.LongTensor([[0]]).to(self.device)}, m=n,
-                                         do={'X': T.LongTensor([[0]]).to(self.device)}, return_biased=self.biased))
+                                         do={'X': T.LongTensor([[0]]).to(self.device)},
+                                         return_biased=self.biased, chunk_size=self.chunk_size))
         y0_do1 = T.exp(-self.ncm.nll_marg({'Y': T.LongTensor([[0]]).to(self.device)}, m=n,
-                                         do={'X': T.LongTensor([[1]]).to(self.device)}, return_biased=self.biased))
+                                         do={'X': T.LongTensor([[1]]).to(self.device)},
+                                         return_biased=self.biased, chunk_size=self.chunk_size))
         y1_do0 = T.exp(-self.ncm.nll_marg({'Y': T.LongTensor([[1]]).to(self.device)}, m=n,
-                                         do={'X': T.LongTensor([[0]]).to(self.device)}, return_biased=self.biased))
+                                         do={'X': T.LongTensor([[0]]).to(self.device)},
+                                         return_biased=self.biased, chunk_size=self.chunk_size))
         y1_do1 = T.exp(-self.ncm.nll_marg({'Y': T.LongTensor([[1]]).to(self.device)}, m=n,
-                                         do={'X': T.LongTensor([[1]]).to(self.device)}, return_biased=self.biased))
+                                         do={'X': T.LongTensor([[1]]).to(self.device)},
+                                         return_biased=self.biased, chunk_size=self.chunk_size))
 
         if self.maximize:
             #return (-ate + 1.0) / 2.0
             y1_do1_norm = (y1_do1 / (y0_do1 + y1_do1)).float()
             y0_do0_norm = (y0_do0 / (y0_do0 + y1_do0)).float()
-            if (y0_do0_norm <= 0).any():
-                y0_do0_norm = self.precision_check(y0_do0_norm)
-            if (y1_do1_norm <= 0).any():
-                y1_do1_norm = self.precision_check(y1_do1_norm)
+            y0_do0_norm = T.where((y0_do0_norm <= 0).any(), self.precision_check(y0_do0_norm),
+                                   y0_do0_norm)
+            y1_do1_norm = T.where((y1_do1_norm <= 0).any(), self.precision_check(y1_do1_norm),
+                                   y1_do1_norm)
             ate_pen = -T.log(y1_do1_norm.float()).mean() - T.log(y0_do0_norm.float()).mean()
             return ate_pen
         else:
             #return (ate + 1.0) / 2.0
             y1_do0_norm = (y1_do0 / (y0_do0 + y1_do0)).float()
             y0_do1_norm = (y0_do1 / (y0_do1 + y1_do1)).float()
-            if (y1_do0_norm <= 0).any():
-                y1_do0_norm = self.precision_check(y1_do0_norm)
-            if (y0_do1_norm <= 0).any():
-                y0_do1_norm = self.precision_check(y0_do1_norm)
+            y1_do0_norm = T.where((y1_do0_norm <= 0).any(), self.precision_check(y1_do0_norm),
+                                   y1_do0_norm)
+            y0_do1_norm = T.where((y0_do1_norm <= 0).any(), self.precision_check(y0_do1_norm),
+                                   y0_do1_norm)
             ate_pen = -T.log(y0_do1_norm.float()).mean() - T.log(y1_do0_norm.float()).mean()
             return ate_pen
 
     def tv_loss(self, n=1000000):
         y0x0 = T.exp(-self.ncm.nll_marg({'Y': T.LongTensor([[0]]).to(self.device),
                                          'X': T.LongTensor([[0]]).to(self.device)},
-                                        m=n, return_biased=self.biased))
+                                        m=n, return_biased=self.biased,
+                                        chunk_size=self.chunk_size))
         y0x1 = T.exp(-self.ncm.nll_marg({'Y': T.LongTensor([[0]]).to(self.device),
                                          'X': T.LongTensor([[1]]).to(self.device)},
-                                        m=n, return_biased=self.biased))
+                                        m=n, return_biased=self.biased,
+                                        chunk_size=self.chunk_size))
         y1x0 = T.exp(-self.ncm.nll_marg({'Y': T.LongTensor([[1]]).to(self.device),
                                          'X': T.LongTensor([[0]]).to(self.device)},
-                                        m=n, return_biased=self.biased))
+                                        m=n, return_biased=self.biased,
+                                        chunk_size=self.chunk_size))
         y1x1 = T.exp(-self.ncm.nll_marg({'Y': T.LongTensor([[1]]).to(self.device),
                                          'X': T.LongTensor([[1]]).to(self.device)},
-                                        m=n, return_biased=self.biased))
+                                        m=n, return_biased=self.biased,
+                                        chunk_size=self.chunk_size))
 
         y1_g0 = y1x0 / (y1x0 + y0x0)
         y1_g1 = y1x1 / (y1x1 + y0x1)
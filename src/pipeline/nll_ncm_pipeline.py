@@ -11,25 +11,20 @@ from .base_pipeline import BasePipeline
 
 class NLLNCMPipeline(BasePipeline):
     patience = 60
+    n_groups = 8  # independent SUMO estimators per accumulated batch, splitting its m samples
+    state_attrs = ('accumulate_batches', 'last_loss', 'last_loss_sem')
 
     def __init__(self, ctm, dat, cg_file):
         ncm = NCM(CausalGraph.read(cg_file))
         super().__init__(ctm, dat, cg_file, ncm)
 
         self.automatic_optimization = False
-        self.nlpv = metric.probability_table(dat=dat)
-        self.nlpv['_nlpv'] = -np.log(self.nlpv['P(V)'].astype(np.float32))
 
         self.accumulate_batches = 1
         self.last_loss = None
         self.last_loss_sem = None
 
-        space = list(self.ncm.space())
-        self.nlpvs = [T.tensor(
-            (lambda x: 0 if len(x) == 0 else x.item())
-            (self.nlpv.query(' and '.join(f'{k} == {val.item()}'
-                                          for k, val in v.items()))._nlpv)).float()
-            for v in space]
+        self.init_targets()
 
     def forward(self, n=1000, u=None, do={}):
         return self.ncm(n, u, do)
@@ -43,52 +38,59 @@ class NLLNCMPipeline(BasePipeline):
         }
 
     def training_step(self, batch, batch_idx):
-        if self.current_epoch == 25:
-            self.accumulate_batches = 2
+        # each accumulated batch of m SUMO samples is split into n_groups independent estimators,
+        # so the spread of their losses gives the SEM from the same single pass
         if self.last_loss is not None and self.last_loss_sem > T.abs(self.last_loss) * 0.25:
             self.accumulate_batches = min(self.accumulate_batches * 2, 32)
 
         m = int(1.6e6)
+        acc = self.accumulate_batches
+        k = acc * self.n_groups
         opt = self.optimizers()
-        nll_agg = []
-        nlpv_agg = []
         opt.zero_grad()
-        space = list(self.ncm.space())
-        biased_losses = []
-        losses = []
-        for _ in range(self.accumulate_batches):
-            batch_loss = 0
-            batch_biased_loss = 0
-            for v, nlpv in zip(space, self.nlpvs):
-                nll, biased_nll = self.ncm.nll(v, m=m, return_biased=True)
-                loss = T.exp(-nlpv) * (nll - nlpv)
-                biased_loss = T.exp(-nlpv) * (biased_nll - nlpv)
-                self.manual_backward(loss, opt)
-                nll_agg.append(nll.item())
-                nlpv_agg.append(nlpv.item())
-                batch_loss += loss.item()
-                batch_biased_loss += biased_loss.item()
-                del nll, loss
-            losses.append(batch_loss)
-            biased_losses.append(batch_biased_loss)
+        space, nlpvs = self.step_targets(batch)
+        nll_agg = T.zeros(len(space), dtype=T.float64)
+        nlpv_agg = [nlpv.item() for nlpv in nlpvs]
+        losses = T.zeros(k)
+        biased_loss_agg = 0
+        # one batch at a time, so that only the graph of n_groups estimators is held
+        for j in range(acc):
+            group = slice(j * self.n_groups, (j + 1) * self.n_groups)
+            for i, (v, nlpv) in enumerate(zip(space, nlpvs)):
+                with self.mechanism_autocast():
+                    nll, biased_nll = self.ncm.nll(v, n=self.n_groups, m=m // self.n_groups,
+                                                   return_biased=True, chunk_size=self.chunk_size,
+                                                   reduce=False)
+                group_losses = T.exp(-nlpv) * (nll.reshape(self.n_groups) - nlpv)
+                nll = nll.mean()
+                self.backward_target(group_losses.mean(), nll, opt, weight=1 / acc)
+                nll_agg[i] += nll.item() / acc
+                losses[group] += group_losses.detach().float().cpu()
+                biased_loss_agg += (T.exp(-nlpv) * (biased_nll - nlpv)).item() / acc
+                del nll, biased_nll, group_losses
+        nll_agg = nll_agg.tolist()
+        if self.sparse:
+            losses += self.unseen_value(nll_agg)
+        self.sync_gradients()
+        losses = self.all_reduce(losses)
+        biased_loss_agg = self.all_reduce(biased_loss_agg)
         opt.step()
-        losses = T.tensor(losses)
         self.last_loss = losses.mean()
-        self.last_loss_sem = losses.std() / (self.accumulate_batches ** .5)
+        self.last_loss_sem = losses.std() / (k ** .5)
         self.log('train_loss', self.last_loss, prog_bar=True)
-        self.log('biased_loss', T.tensor(biased_losses).mean(), prog_bar=True)
+        self.log('biased_loss', biased_loss_agg, prog_bar=True)
         self.log('sem', self.last_loss_sem, prog_bar=True)
         self.log('lr', opt.param_groups[0]['lr'], prog_bar=True)
         self.log('acc', self.accumulate_batches, prog_bar=True)
 
         # logging
         if (self.current_epoch + 1) % 10 == 0:
-            results = metric.all_metrics(self.ctm, self.ncm, self.dat,
-                                         self.cg_file, n=10000)
-            for k, v in results.items():
-                self.log(k, v)
+            self.evaluate_metrics(10000)
+        for epoch, results in self.log_evaluations():
+            if (epoch + 1) % 200 == 0:
+                print(pd.Series(results))
 
-        if (self.current_epoch + 1) % 200 == 0:
+        if (self.current_epoch + 1) % 200 == 0 and self.is_lead():
             with T.no_grad():
                 nlpv = T.tensor(nlpv_agg)
                 nll = T.tensor(nll_agg)
@@ -98,4 +100,3 @@ class NLLNCMPipeline(BasePipeline):
                     T.exp(-nlpv) * (nll - nlpv)
                 ], dim=-1).numpy()
                 print(pd.DataFrame(arr, columns=['P*(V)', 'P(V)', 'loss']))
-            print(pd.Series(results))
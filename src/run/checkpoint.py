@@ -0,0 +1,128 @@
+import atexit
+import os
+import threading
+import time
+import weakref
+
+import torch as T
+from pytorch_lightning.plugins.io import CheckpointIO
+
+
+def snapshot(obj):
+    # copy of a checkpoint that later optimizer steps cannot change, with tensors on the CPU
+    if T.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)) and not hasattr(obj, '_fields'):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f'{path}.tmp'
+    T.save(obj, tmp)
+    os.replace(tmp, path)
+
+
+_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_writers():
+    # the writer threads are daemons, so pending saves would be lost when the interpreter exits
+    for writer in list(_writers):
+        writer.flush()
+
+
+class BackgroundWriter:
+    """
+    Persists checkpoints from a background thread, at most once every min_interval seconds.
+
+    submit() only takes an in-memory snapshot; saves to a path that is still pending replace the
+    pending one, so intermediate states are coalesced and only the latest is written. Files are
+    written atomically (to a temporary file, then renamed). flush() writes everything pending and
+    waits for it; it runs for all writers at interpreter exit, but forked workers exit without
+    it and must flush before returning.
+    """
+
+    def __init__(self, min_interval=60.):
+        self.min_interval = min_interval
+        self.pending = {}
+        self.last_write = -float('inf')
+        self.writing = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = None
+        _writers.add(self)
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                delay = self.last_write + self.min_interval - time.monotonic()
+                if delay > 0:
+                    self.cond.wait(delay)  # woken early by flush()
+                    if time.monotonic() < self.last_write + self.min_interval:
+                        continue
+                jobs, self.pending = self.pending, {}
+                self.writing = True
+            try:
+                for path, obj in jobs.items():
+                    atomic_save(obj, path)
+            except Exception as e:
+                self.error = e
+            with self.cond:
+                self.last_write = time.monotonic()
+                self.writing = False
+                self.cond.notify_all()
+
+    def submit(self, obj, path):
+        obj = snapshot(obj)
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._worker, daemon=True)
+                self.thread.start()
+            self.pending[path] = obj
+            self.cond.notify_all()
+
+    def remove(self, path):
+        # drop a pending save of path and delete any written file, without forcing other writes
+        with self.cond:
+            self.pending.pop(path, None)
+            while self.writing:
+                self.cond.wait()
+        if os.path.isfile(path):
+            os.remove(path)
+
+    def flush(self):
+        with self.cond:
+            while self.pending or self.writing:
+                self.last_write = -float('inf')
+                self.cond.notify_all()
+                self.cond.wait()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+class ThrottledCheckpointIO(CheckpointIO):
+    """Lightning checkpoint plugin that saves through a BackgroundWriter."""
+
+    def __init__(self, min_interval=60.):
+        self.writer = BackgroundWriter(min_interval)
+
+    def save_checkpoint(self, checkpoint, path, storage_options=None):
+        self.writer.submit(checkpoint, str(path))
+
+    def load_checkpoint(self, path, map_location=None):
+        self.writer.flush()
+        return T.load(path, map_location=map_location)
+
+    def remove_checkpoint(self, path):
+        self.writer.remove(str(path))
+
+    def teardown(self):
+        self.writer.flush()
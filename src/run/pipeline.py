@@ -6,8 +6,9 @@ import itertools
 import json
 import os
 import shutil
+import socket
 import time
-from contextlib import contextmanager
+from contextlib import ExitStack, contextmanager
 from email.message import EmailMessage
 from smtplib import SMTP
 from socket import gethostname
@@ -17,14 +18,17 @@ from collections import OrderedDict
 import numpy as np
 import pytorch_lightning as pl
 import torch as T
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch.utils.data import Dataset
 from tqdm.auto import tqdm
 
 from src import metric, pipeline
-from src.ds import CausalGraph
+from src.ds import CausalGraph, CountTable
 from src.scm import CTM
 from src.scm.model_families import XORModel
 from src.pipeline import NLLNCMMaxPipeline
+from src.run.checkpoint import BackgroundWriter, ThrottledCheckpointIO
 from src.metric.werm import werm_ate
 from src.metric.tv_nn import naive_nn_tv
 
@@ -75,7 +79,8 @@ def interventional_is_observational(g, x='X', y='Y'):
                    for k in itertools.chain(g.v, g.bi))
 
 
-def datagen(cg_file=None, n=500000, dat=None, dim=1, min_ate_tv_diff=0.05, adjust_ate=False):
+def datagen(cg_file=None, n=500000, dat=None, dim=1, min_ate_tv_diff=0.05, adjust_ate=False,
+            exact_sampling=False, counts=False, batch_size=2 ** 18):
     assert (cg_file is None) != (dat is None)
 
     # create true data-generating model
@@ -100,11 +105,11 @@ def datagen(cg_file=None, n=500000, dat=None, dim=1, min_ate_tv_diff=0.05, adjus
                         break
 
                     optim.zero_grad()
-                    ate = (ctm.pmf({'Y': 1}, do={'X': T.tensor([[1]])})
-                           - ctm.pmf({'Y': 1}, do={'X': T.tensor([[0]])}))
+                    ate = (ctm.table(do={'X': 1}, select=['Y'])[1]
+                           - ctm.table(do={'X': 0}, select=['Y'])[1])
                     assert not T.isnan(ate), f'ate is nan, step {step}'
-                    tv = (ctm.pmf({'Y': 1}, cond={'X': 1})
-                          - ctm.pmf({'Y': 1}, cond={'X': 0}))
+                    pxy = ctm.table(select=['X', 'Y'])
+                    tv = pxy[1, 1] / pxy[1].sum() - pxy[0, 1] / pxy[0].sum()
                     assert not T.isnan(tv), f'tv is nan, step {step}'
                     ate_tv_diff = T.abs(ate - tv)
                     (-ate_tv_diff).backward()
@@ -112,9 +117,21 @@ def datagen(cg_file=None, n=500000, dat=None, dim=1, min_ate_tv_diff=0.05, adjus
                 else:
                     raise ValueError(f'> {max_steps} steps optimizing CTM')
 
-    # generate data
+    # generate data, from the exact joint table if it is small enough; with counts, as a
+    # CountTable accumulated over batches of samples instead of n rows
     if dat is None:
-        dat = ctm(n)
+        exact = exact_sampling and 2 ** len(ctm.v) <= ctm.max_table_size
+        if counts and len(ctm.v) <= CountTable.max_bits:
+            if exact:
+                dat = CountTable.from_dense({k: 1 for k in ctm.v}, ctm.sample_table(n, counts=True))
+            else:
+                dat = CountTable({k: 1 for k in ctm.v})
+                for i in range(0, n, batch_size):
+                    dat.update(ctm(min(batch_size, n - i)))
+        elif exact:
+            dat = ctm.sample_table(n)
+        else:
+            dat = ctm(n)
 
     return ctm, dat
 
@@ -143,6 +160,319 @@ def lock(file, lockinfo):  # attempt to acquire a file lock; yield whether or no
         yield False
 
 
+class NativeTrainer:
+    '''
+    Minimal stand-in for the pl.Trainer built in run and run_id: drives a pipeline's
+    training_step directly, with its Lightning calls (optimizers, manual_backward, log,
+    current_epoch) served by BasePipeline through this trainer.
+
+    As with Lightning's EarlyStopping, training stops once the last logged monitor value of an
+    epoch has not improved by min_delta for patience epochs (never if patience is None) or is not
+    finite. Like ModelCheckpoint without a monitor, the checkpoint (best_model_path) is the state
+    after the last epoch. It is also written every every_n_epochs with the optimizer,
+    early-stopping and pipeline states, so that fit(m, ckpt_path) resumes an interrupted run;
+    these writes go through a BackgroundWriter, at most every checkpoint_interval seconds. As
+    with manual optimization in Lightning, LR schedulers are left to the pipeline. Outside
+    minibatch mode, batches are not drawn from the data, since training_step does not use them.
+    '''
+    CHECKPOINT_NAME_LAST = 'native_last'
+    FILE_EXTENSION = '.ckpt'
+
+    def __init__(self, max_epochs, patience=None, min_delta=0., dirpath=None, logger=None,
+                 log_every_n_steps=10, monitor='train_loss', every_n_epochs=1,
+                 checkpoint_interval=60.):
+        self.max_epochs = max_epochs
+        self.patience = patience
+        self.min_delta = min_delta
+        self.dirpath = dirpath
+        self.logger = logger
+        self.log_every_n_steps = log_every_n_steps
+        self.monitor = monitor
+        self.every_n_epochs = every_n_epochs
+        self.writer = BackgroundWriter(checkpoint_interval)
+        self.current_epoch = 0
+        self.global_step = 0
+        self.optimizer = None
+        self.metrics = {}
+        self.best_model_path = None
+        self.best_score = np.inf
+        self.wait_count = 0
+        self.stopped = False
+
+    def log(self, name, value):
+        self.metrics[name] = float(value)
+
+    def save_checkpoint(self, m, path):
+        checkpoint = {'epoch': self.current_epoch, 'global_step': self.global_step,
+                      'state_dict': m.state_dict(),
+                      'optimizer_states': [self.optimizer.state_dict()],
+                      'early_stopping': {'best_score': self.best_score,
+                                         'wait_count': self.wait_count, 'stopped': self.stopped}}
+        m.on_save_checkpoint(checkpoint)
+        self.writer.submit(checkpoint, path)
+
+    def load_checkpoint(self, m, path):
+        checkpoint = T.load(path)
+        m.load_state_dict(checkpoint['state_dict'])
+        self.optimizer.load_state_dict(checkpoint['optimizer_states'][0])
+        self.current_epoch = checkpoint['epoch'] + 1
+        self.global_step = checkpoint['global_step']
+        self.best_score = checkpoint['early_stopping']['best_score']
+        self.wait_count = checkpoint['early_stopping']['wait_count']
+        self.stopped = checkpoint['early_stopping']['stopped']
+        m.on_load_checkpoint(checkpoint)
+
+    def fit(self, m, ckpt_path=None):
+        cfg = m.configure_optimizers()
+        self.optimizer = cfg['optimizer'] if isinstance(cfg, dict) else cfg
+        if ckpt_path is not None:
+            self.load_checkpoint(m, ckpt_path)
+        last_path = None
+        if self.dirpath is not None:
+            last_path = f'{self.dirpath}/{self.CHECKPOINT_NAME_LAST}{self.FILE_EXTENSION}'
+        loader = m.train_dataloader()
+        m.native = self
+        m.train()
+        try:
+            for epoch in range(self.current_epoch, self.max_epochs):
+                if self.stopped:
+                    break
+                self.current_epoch = epoch
+                batches = iter(loader) if m.minibatch else itertools.repeat(None, len(loader))
+                for batch_idx, batch in enumerate(batches):
+                    m.training_step(batch, batch_idx)
+                    self.global_step += 1
+                    if self.logger is not None and self.global_step % self.log_every_n_steps == 0:
+                        self.logger.log_metrics(dict(self.metrics, epoch=epoch),
+                                                step=self.global_step)
+
+                current = self.metrics.get(self.monitor, np.nan)
+                if not np.isfinite(current):
+                    self.stopped = True
+                elif current < self.best_score - self.min_delta:
+                    self.best_score = current
+                    self.wait_count = 0
+                else:
+                    self.wait_count += 1
+                    self.stopped = self.patience is not None and self.wait_count >= self.patience
+                if last_path is not None and (epoch + 1) % self.every_n_epochs == 0:
+                    self.save_checkpoint(m, last_path)
+            m.on_train_end()
+        finally:
+            m.native = None
+            if self.logger is not None:
+                self.logger.finalize('success')
+        if last_path is not None:
+            self.stopped = True
+            self.save_checkpoint(m, last_path)
+            self.writer.flush()
+            self.best_model_path = last_path
+
+
+def share_memory(m):
+    # move the data and targets of a pipeline into shared memory before forking workers
+    dat = m.dat.__dict__ if isinstance(m.dat, CountTable) else m.dat
+    for v in dat.values():
+        if T.is_tensor(v):
+            v.share_memory_()
+    if T.is_tensor(getattr(m, 'nlpvs', None)):
+        m.nlpvs.share_memory_()
+
+
+def clear_dir(d, keep=('lock', 'checkpoints', 'logs')):
+    # delete the files of an incomplete run, keeping its lock and what is needed to resume
+    for file in glob.glob(f'{d}/*'):
+        if os.path.basename(file) not in keep:
+            if os.path.isdir(file):
+                shutil.rmtree(file)
+            else:
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
+
+
+def flush_checkpoints(trainer):
+    # Lightning does not tear down its checkpoint plugin, so saves still queued by a
+    # ThrottledCheckpointIO are written here, before best_model_path is read
+    if isinstance(trainer, NativeTrainer):
+        trainer.writer.flush()
+        return
+    plugin = getattr(trainer, 'strategy', None) or getattr(trainer, 'training_type_plugin', None)
+    checkpoint_io = getattr(plugin, 'checkpoint_io', None)
+    if isinstance(checkpoint_io, ThrottledCheckpointIO):
+        checkpoint_io.writer.flush()
+
+
+def fit_result(dirpath, result=None):
+    # (best_model_path, train_time) of a finished fit, recorded next to its checkpoints, since
+    # resuming from the last checkpoint would not restore an early stop and would train on
+    path = f'{dirpath}/fit_result.json'
+    if result is not None:
+        os.makedirs(dirpath, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump(result, file)
+    elif os.path.isfile(path):
+        with open(path) as file:
+            return tuple(json.load(file))
+    return result
+
+
+def fit(m, create_trainer):
+    # resume from the last full-state checkpoint of an interrupted fit, if there is one
+    trainer, checkpoint = create_trainer()
+    result = fit_result(checkpoint.dirpath)
+    if result is not None:
+        print('Already fit', checkpoint.dirpath)
+        return result
+    last = os.path.join(checkpoint.dirpath,
+                        checkpoint.CHECKPOINT_NAME_LAST + checkpoint.FILE_EXTENSION)
+    start_time = time.time()
+    if os.path.isfile(last):
+        print('Resuming from', last)
+        trainer.fit(m, ckpt_path=last)
+    else:
+        trainer.fit(m)
+    flush_checkpoints(trainer)
+    return fit_result(checkpoint.dirpath, (checkpoint.best_model_path, time.time() - start_time))
+
+
+def _fit_worker(queue, i, m, create_trainer, n_threads, seed):
+    T.set_num_threads(n_threads)
+    T.manual_seed(seed)
+    np.random.seed(seed)
+    try:
+        queue.put((i, fit(m, create_trainer)))
+    except Exception as e:  # re-raised by the parent
+        queue.put((i, RuntimeError(f'fit {i} failed: {e!r}')))
+        raise
+
+
+def _get_result(queue, processes):
+    # next (i, result) of a fit worker; raise if a worker failed or died before putting one
+    while queue.empty():
+        if any(p.exitcode not in (None, 0) for p in processes):
+            break
+        time.sleep(0.1)
+    if not queue.empty():
+        i, result = queue.get()
+        if not isinstance(result, Exception):
+            return i, result
+    else:
+        result = RuntimeError('fit worker exited with code %s' % [p.exitcode for p in processes])
+    for p in processes:
+        p.terminate()
+    raise result
+
+
+def _shard_worker(queue, rank, n_shards, port, m, create_trainer, n_threads, seed):
+    T.set_num_threads(n_threads)
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank,
+                            world_size=n_shards)
+    try:
+        # all ranks start from the parameters of rank 0 and draw their own U samples
+        for t in m.state_dict().values():
+            dist.broadcast(t, 0)
+        T.manual_seed(seed + rank)
+        np.random.seed((seed + rank) & 0xffffffff)
+        trainer, checkpoint = create_trainer()
+        assert isinstance(trainer, NativeTrainer), 'sharded fits need a NativeTrainer'
+        last = f'{trainer.dirpath}/{trainer.CHECKPOINT_NAME_LAST}{trainer.FILE_EXTENSION}'
+        result = fit_result(trainer.dirpath)
+        if result is None:
+            dirpath = trainer.dirpath
+            if rank > 0:
+                trainer.logger = trainer.dirpath = None
+            start_time = time.time()
+            trainer.fit(m, ckpt_path=last if os.path.isfile(last) else None)
+            flush_checkpoints(trainer)
+            if rank == 0:
+                result = fit_result(dirpath, (checkpoint.best_model_path, time.time() - start_time))
+        if rank == 0:
+            queue.put(result)
+    finally:
+        dist.destroy_process_group()
+
+
+def fit_sharded(m, create_trainer, n_shards):
+    '''
+    Fit m like fit, with its configurations sharded over n_shards forked processes on this
+    machine. Every step, the shards sum their gradients (and losses) with gloo all-reduces before
+    the optimizer step, so all of them take the same step as a single process would; terms outside
+    the per-configuration sum, metrics, logs and checkpoints belong to rank 0.
+    '''
+    assert not T.cuda.is_initialized(), 'sharded fits fork workers and cannot share CUDA'
+    ctx = mp.get_context('fork')
+    queue = ctx.SimpleQueue()
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    n_threads = max(1, T.get_num_threads() // n_shards)
+    seed = T.initial_seed() + 1
+    share_memory(m)
+    processes = [ctx.Process(target=_shard_worker, args=(
+        queue, rank, n_shards, port, m, create_trainer, n_threads, seed))
+        for rank in range(n_shards)]
+    for p in processes:
+        p.start()
+    while queue.empty():
+        if any(p.exitcode not in (None, 0) for p in processes):
+            for p in processes:
+                p.terminate()
+            raise RuntimeError('shard worker exited with code %s'
+                               % [p.exitcode for p in processes])
+        time.sleep(0.1)
+    result = queue.get()
+    for p in processes:
+        p.join()
+    return result
+
+
+def fit_all(jobs, n_jobs=1, n_shards=1):
+    '''
+    Fit each (pipeline, create_trainer) pair in jobs and load its best checkpoint; return the
+    training times. With n_jobs > 1, up to n_jobs fits run at once in forked worker processes
+    that share the data and split the intra-op threads, each seeded from the current seed. With
+    n_shards > 1, each fit in turn is sharded over n_shards processes instead (see fit_sharded).
+    '''
+    results = [None] * len(jobs)
+    if n_shards > 1:
+        for i, (m, create_trainer) in enumerate(jobs):
+            results[i] = fit_sharded(m, create_trainer, n_shards)
+    elif n_jobs == 1:
+        for i, (m, create_trainer) in enumerate(jobs):
+            results[i] = fit(m, create_trainer)
+    else:
+        assert not T.cuda.is_initialized(), 'concurrent fits fork workers and cannot share CUDA'
+        ctx = mp.get_context('fork')
+        queue = ctx.SimpleQueue()
+        n_threads = max(1, T.get_num_threads() // n_jobs)
+        base_seed = T.initial_seed()
+        for m, _ in jobs:
+            share_memory(m)
+        processes = []
+        for i, (m, create_trainer) in enumerate(jobs):
+            if len(processes) - sum(r is not None for r in results) >= n_jobs:
+                j, result = _get_result(queue, processes)
+                results[j] = result
+            processes.append(ctx.Process(target=_fit_worker, args=(
+                queue, i, m, create_trainer, n_threads, (base_seed + i + 1) & 0xffffffff)))
+            processes[-1].start()
+        while any(r is None for r in results):
+            j, result = _get_result(queue, processes)
+            results[j] = result
+        for p in processes:
+            p.join()
+            if p.exitcode != 0:
+                raise RuntimeError(f'fit worker exited with code {p.exitcode}')
+
+    times = []
+    for (m, _), (best_model_path, train_time) in zip(jobs, results):
+        m.load_state_dict(T.load(best_model_path)['state_dict'])
+        times.append(train_time)
+    return times
+
+
 def get_key(cg_file, n, dim, trial_index):
     graph = cg_file.split('/')[-1].split('.')[0]
     return ('graph=%s-n_samples=%s-dim=%s-trial_index=%s'
@@ -150,7 +480,10 @@ def get_key(cg_file, n, dim, trial_index):
 
 
 def run(pipeline, cg_file, n, dim, trial_index, gpu=None,
-        lockinfo=os.environ.get('SLURM_JOB_ID', ''), minmax=False):
+        lockinfo=os.environ.get('SLURM_JOB_ID', ''), minmax=False, n_jobs=1, native=False,
+        checkpoint_interval=60., log_flush_secs=120, n_shards=1, exact_sampling=False,
+        counts=False):
+    native = native or n_shards > 1
     key = get_key(cg_file, n, dim, trial_index)
     d = 'out/%s/%s' % (pipeline.__name__, key)  # name of the output directory
 
@@ -165,17 +498,10 @@ def run(pipeline, cg_file, n, dim, trial_index, gpu=None,
                 print('[done]', d)
                 return
 
-            # since training is not complete, delete all directory files except for the lock
+            # since training is not complete, delete all directory files except for the lock and
+            # the checkpoints and logs to resume from
             print('[running]', d)
-            for file in glob.glob(f'{d}/*'):
-                if os.path.basename(file) != 'lock':
-                    if os.path.isdir(file):
-                        shutil.rmtree(file)
-                    else:
-                        try:
-                            os.remove(file)
-                        except FileNotFoundError:
-                            pass
+            clear_dir(d)
 
             # set random seed to a hash of the parameter settings for reproducibility
             seed = int(hashlib.sha512(key.encode()).hexdigest(), 16) & 0xffffffff
@@ -186,7 +512,8 @@ def run(pipeline, cg_file, n, dim, trial_index, gpu=None,
 
             # generate data-generating model, data, and model
             print('Generating data')
-            ctm, dat = datagen(cg_file, n=n, dim=dim)
+            ctm, dat = datagen(cg_file, n=n, dim=dim, exact_sampling=exact_sampling,
+                               counts=counts)
             m = pipeline(ctm, dat, cg_file)
 
             """
@@ -203,8 +530,17 @@ def run(pipeline, cg_file, n, dim, trial_index, gpu=None,
             
 
             # function for building pytorch-lightning trainer
-            def create_trainer(gpu=None):
-                checkpoint = pl.callbacks.ModelCheckpoint(dirpath=f'{d}/checkpoints/')
+            def create_trainer(gpu=None, name='', version=None):
+                if native:
+                    trainer = NativeTrainer(
+                        pipeline.max_epochs, patience=pipeline.patience,
+                        min_delta=pipeline.min_delta, dirpath=f'{d}/checkpoints/{name}',
+                        checkpoint_interval=checkpoint_interval,
+                        logger=pl.loggers.TensorBoardLogger(f'{d}/logs/', version=version,
+                                                            flush_secs=log_flush_secs))
+                    return trainer, trainer
+                checkpoint = pl.callbacks.ModelCheckpoint(dirpath=f'{d}/checkpoints/{name}',
+                                                          save_last=True)
                 return pl.Trainer(
                     callbacks=[
                         checkpoint,
@@ -214,9 +550,11 @@ def run(pipeline, cg_file, n, dim, trial_index, gpu=None,
                                                    #check_on_train_epoch_end=True
                                                    ),
                     ],
+                    plugins=[ThrottledCheckpointIO(checkpoint_interval)],
                     max_epochs=pipeline.max_epochs,
                     accumulate_grad_batches=1,
-                    logger=pl.loggers.TensorBoardLogger(f'{d}/logs/'),
+                    logger=pl.loggers.TensorBoardLogger(f'{d}/logs/', version=version,
+                                                        flush_secs=log_flush_secs),
                     log_every_n_steps=10,
                     #terminate_on_nan=True,
                     #gpus=gpu
@@ -230,22 +568,11 @@ def run(pipeline, cg_file, n, dim, trial_index, gpu=None,
                 m_max = pipeline(ctm, dat, cg_file, maximize=True)
                 if gpu is None:
                     gpu = int(T.cuda.is_available())
-                trainer_min, checkpoint_min = create_trainer(gpu)
-                trainer_max, checkpoint_max = create_trainer(gpu)
-                print("\nTraining min model...")
-                start_time = time.time()
-                trainer_min.fit(m_min)
-                min_train_time = time.time() - start_time
-
-                ckpt = T.load(checkpoint_min.best_model_path)
-                m_min.load_state_dict(ckpt['state_dict'])
-                print("\nTraining max model...")
-                start_time = time.time()
-                trainer_max.fit(m_max)
-                max_train_time = time.time() - start_time
-
-                ckpt = T.load(checkpoint_max.best_model_path)
-                m_max.load_state_dict(ckpt['state_dict'])
+                print("\nTraining min and max models...")
+                min_train_time, max_train_time = fit_all([
+                    (m_min, functools.partial(create_trainer, gpu, 'min', 0)),
+                    (m_max, functools.partial(create_trainer, gpu, 'max', 1)),
+                ], n_jobs=n_jobs, n_shards=n_shards)
 
                 results = metric.all_metrics_minmax(
                     m_min.ctm, m_min.ncm, m_max.ncm, m_min.dat, m_min.cg_file, n=100000)
@@ -266,13 +593,9 @@ def run(pipeline, cg_file, n, dim, trial_index, gpu=None,
                 m = pipeline(ctm, dat, cg_file)
                 if gpu is None:
                     gpu = int(T.cuda.is_available())
-                trainer, checkpoint = create_trainer(gpu)
-                start_time = time.time()
-                trainer.fit(m)
-                train_time = time.time() - start_time
                 # load_from_checkpoint() doesn't work
-                ckpt = T.load(checkpoint.best_model_path)
-                m.load_state_dict(ckpt['state_dict'])
+                train_time, = fit_all([(m, functools.partial(create_trainer, gpu))],
+                                      n_shards=n_shards)
                 #results = metric.all_metrics(
                     #m.ctm, m.ncm, m.dat, m.cg_file, n=1000)
                 results = metric.mad_metrics(
@@ -288,28 +611,120 @@ def run(pipeline, cg_file, n, dim, trial_index, gpu=None,
 
                 return m, results
         except Exception:
-            # move out/*/* to err/*/*/#
-            e = d.replace("out/", "err/").rsplit('-', 1)[0]
-            e_index = len(glob.glob(e + '/*'))
-            e += '/%s' % e_index
-            os.makedirs(e.rsplit('/', 1)[0], exist_ok=True)
-            shutil.move(d, e)
-            print(f'moved {d} to {e}')
+            move_to_err(d)
             raise
 
 
-def run_id(folder_name, graph, graph_args, n, dim, n_epochs, trial_index, num_reruns,
-           lockinfo=os.environ.get('SLURM_JOB_ID', ''), gpu=None):
-    pipeline = NLLNCMMaxPipeline
+def id_parameters(graph_args, n, dim, n_epochs, trial_index):
+    if isinstance(graph_args, str):
+        return ('graph=%s-n_samples=%s-dim=%s-n_epochs=%s-trial_index=%s'
+                % (graph_args, n, dim, n_epochs, trial_index))
+    return ('n_samples=%s-dim=%s-n_epochs=%s-n_vars=%s-p_dir=%s-p_bidir=%s-enf_dir=%s-enf_bidir=%s-'
+            'trial_index=%s'
+            % (n, dim, n_epochs, graph_args["n_vars"], graph_args["p_dir"], graph_args["p_bidir"],
+               graph_args["enf_dir"], graph_args["enf_bidir"], trial_index))
+
+
+def move_to_err(d):
+    # move out/*/* to err/*/*/#
+    e = d.replace("out/", "err/").rsplit('-', 1)[0]
+    e_index = len(glob.glob(e + '/*'))
+    e += '/%s' % e_index
+    os.makedirs(e.rsplit('/', 1)[0], exist_ok=True)
+    shutil.move(d, e)
+    print(f'moved {d} to {e}')
+
+
+def id_data(d, parameters, graph, graph_args, n, dim, exact_sampling=False, counts=False):
+    '''Seed from the parameters and load or generate the data-generating model and data of d.'''
     preset_graph = isinstance(graph_args, str)
+
+    # set random seed to a hash of the parameter settings for reproducibility
+    seed = int(hashlib.sha512(parameters.encode()
+                              ).hexdigest(), 16) & 0xffffffff
+    T.manual_seed(seed)
+    np.random.seed(seed)
+    print('Parameters:', parameters)
+    print('Seed:', seed)
+
+    # save causal diagram
+    if not preset_graph:
+        graph.save(f'{d}/graph.cg')
+
+    # generate data
     if preset_graph:
-        parameters = ('graph=%s-n_samples=%s-dim=%s-n_epochs=%s-trial_index=%s'
-                      % (graph_args, n, dim, n_epochs, trial_index))
+        if os.path.isfile(f'{d}/gen_model.th') and os.path.isfile(f'{d}/dat.th'):
+            dat = T.load(f'{d}/dat.th')
+            gen_model = CTM("dat/cg/{}.cg".format(graph_args)).eval()
+            gen_model.load_state_dict(T.load(f'{d}/gen_model.th'))
+        else:
+            gen_model, dat = datagen("dat/cg/{}.cg".format(graph_args), n=n, dim=dim,
+                                     adjust_ate=False, exact_sampling=exact_sampling,
+                                     counts=counts)
+            T.save(gen_model.state_dict(), f'{d}/gen_model.th')
+            T.save(dat, f'{d}/dat.th')
     else:
-        parameters = ('n_samples=%s-dim=%s-n_epochs=%s-n_vars=%s-p_dir=%s-p_bidir=%s-enf_dir=%s-enf_bidir=%s-'
-                      'trial_index=%s'
-                      % (n, dim, n_epochs, graph_args["n_vars"], graph_args["p_dir"], graph_args["p_bidir"],
-                         graph_args["enf_dir"], graph_args["enf_bidir"], trial_index))
+        gen_model = XORModel(graph, dim=dim, p=0.2, seed=seed)
+        if os.path.isfile(f'{d}/dat.th'):
+            dat = T.load(f'{d}/dat.th')
+        elif counts and sum(gen_model.sizes[k] for k in gen_model.v) <= CountTable.max_bits:
+            dat = CountTable({k: gen_model.sizes[k] for k in gen_model.v})
+            for i in range(0, n, 2 ** 18):
+                dat.update(gen_model(min(2 ** 18, n - i)))
+            T.save(dat, f'{d}/dat.th')
+        else:
+            dat = gen_model(n)
+            T.save(dat, f'{d}/dat.th')
+    return gen_model, dat
+
+
+def id_pending(d, num_reruns):
+    pending = []
+    for r in range(num_reruns):
+        if not os.path.isfile(f'{d}/{r}/best_max.th'):
+            pending.append(r)
+        else:
+            print("Done with run {}.".format(r))
+    return pending
+
+
+def id_models(d, parameters, r, gen_model, dat, graph, n_epochs, pipeline=NLLNCMMaxPipeline):
+    '''Clear rerun r of d (except what is needed to resume), reseed and build its min/max models.'''
+    clear_dir(f'{d}/{r}')
+
+    # reset seed
+    new_params = "{}-run={}".format(parameters, r)
+    seed = int(hashlib.sha512(new_params.encode()).hexdigest(), 16) & 0xffffffff
+    T.manual_seed(seed)
+    np.random.seed(seed)
+    print("Run {} seed: {}".format(r, seed))
+
+    m_min = pipeline(gen_model, dat, graph, maximize=False, max_reg_upper=1.0, max_reg_lower=0.001,
+                     total_iters=n_epochs)
+    m_max = pipeline(gen_model, dat, graph, maximize=True, max_reg_upper=1.0, max_reg_lower=0.001,
+                     total_iters=n_epochs)
+    return m_min, m_max
+
+
+def id_results(d, r, m_min, m_max):
+    results = metric.all_metrics_minmax(
+        m_min.ctm, m_min.ncm, m_max.ncm, m_min.dat, m_min.cg_file, n=100000)
+    print(results)
+
+    # save results
+    with open(f'{d}/{r}/results.json', 'w') as file:
+        json.dump(results, file)
+    T.save(m_min.state_dict(), f'{d}/{r}/best_min.th')
+    T.save(m_max.state_dict(), f'{d}/{r}/best_max.th')
+    return results
+
+
+def run_id(folder_name, graph, graph_args, n, dim, n_epochs, trial_index, num_reruns,
+           lockinfo=os.environ.get('SLURM_JOB_ID', ''), gpu=None, n_jobs=1, replicas=False,
+           native=False, checkpoint_interval=60., log_flush_secs=120, n_shards=1,
+           exact_sampling=False, counts=False):
+    native = native or n_shards > 1
+    parameters = id_parameters(graph_args, n, dim, n_epochs, trial_index)
 
     # name of the output directory
     d = 'out/IDExperiments/%s/%s' % (folder_name, parameters)
@@ -327,47 +742,29 @@ def run_id(folder_name, graph, graph_args, n, dim, n_epochs, trial_index, num_re
 
             # since training is not complete, delete all directory files except for the lock
             print('[running]', d)
-
-            # set random seed to a hash of the parameter settings for reproducibility
-            seed = int(hashlib.sha512(parameters.encode()
-                                      ).hexdigest(), 16) & 0xffffffff
-            T.manual_seed(seed)
-            np.random.seed(seed)
-            print('Parameters:', parameters)
-            print('Seed:', seed)
-
-            # save causal diagram
-            if not preset_graph:
-                graph.save(f'{d}/graph.cg')
-
-            # generate data
-            if preset_graph:
-                if os.path.isfile(f'{d}/gen_model.th') and os.path.isfile(f'{d}/dat.th'):
-                    dat = T.load(f'{d}/dat.th')
-                    gen_model = CTM("dat/cg/{}.cg".format(graph_args)).eval()
-                    gen_model.load_state_dict(T.load(f'{d}/gen_model.th'))
-                else:
-                    gen_model, dat = datagen("dat/cg/{}.cg".format(graph_args), n=n, dim=dim, adjust_ate=False)
-                    T.save(gen_model.state_dict(), f'{d}/gen_model.th')
-                    T.save(dat, f'{d}/dat.th')
-            else:
-                gen_model = XORModel(graph, dim=dim, p=0.2, seed=seed)
-                if os.path.isfile(f'{d}/dat.th'):
-                    dat = T.load(f'{d}/dat.th')
-                else:
-                    dat = gen_model(n)
-                    T.save(dat, f'{d}/dat.th')
+            gen_model, dat = id_data(d, parameters, graph, graph_args, n, dim,
+                                     exact_sampling=exact_sampling, counts=counts)
 
             # function for building pytorch-lightning trainer
-            def create_trainer(rerun_trial, gpu=None):
-                checkpoint = pl.callbacks.ModelCheckpoint(dirpath=f'{d}/{rerun_trial}/checkpoints/')
+            def create_trainer(rerun_trial, gpu=None, name='', version=None):
+                if native:
+                    trainer = NativeTrainer(
+                        n_epochs, dirpath=f'{d}/{rerun_trial}/checkpoints/{name}',
+                        checkpoint_interval=checkpoint_interval,
+                        logger=pl.loggers.TensorBoardLogger(
+                            f'{d}/{rerun_trial}/logs/', version=version, flush_secs=log_flush_secs))
+                    return trainer, trainer
+                checkpoint = pl.callbacks.ModelCheckpoint(
+                    dirpath=f'{d}/{rerun_trial}/checkpoints/{name}', save_last=True)
                 trainer = pl.Trainer(
                     callbacks=[
                         checkpoint
                     ],
+                    plugins=[ThrottledCheckpointIO(checkpoint_interval)],
                     max_epochs=n_epochs,
                     accumulate_grad_batches=1,
-                    logger=pl.loggers.TensorBoardLogger(f'{d}/{rerun_trial}/logs/'),
+                    logger=pl.loggers.TensorBoardLogger(f'{d}/{rerun_trial}/logs/', version=version,
+                                                        flush_secs=log_flush_secs),
                     log_every_n_steps=10,
                     terminate_on_nan=True,
                     gpus=gpu
@@ -375,65 +772,89 @@ def run_id(folder_name, graph, graph_args, n, dim, n_epochs, trial_index, num_re
 
                 return trainer, checkpoint
 
-            for r in range(num_reruns):
-                if not os.path.isfile(f'{d}/{r}/best_max.th'):
-                    # remove all files
-                    for file in glob.glob(f'{d}/{r}/*'):
-                        if os.path.isdir(file):
-                            shutil.rmtree(file)
-                        else:
-                            try:
-                                os.remove(file)
-                            except FileNotFoundError:
-                                pass
-
-                    # reset seed
-                    new_params = "{}-run={}".format(parameters, r)
-                    seed = int(hashlib.sha512(new_params.encode()).hexdigest(), 16) & 0xffffffff
-                    T.manual_seed(seed)
-                    np.random.seed(seed)
-                    print("Run {} seed: {}".format(r, seed))
-
-                    # train model
-                    m_min = pipeline(gen_model, dat, graph, maximize=False, max_reg_upper=1.0, max_reg_lower=0.001,
-                                     total_iters=n_epochs)
-                    m_max = pipeline(gen_model, dat, graph, maximize=True, max_reg_upper=1.0, max_reg_lower=0.001,
-                                     total_iters=n_epochs)
-                    if gpu is None:
-                        gpu = int(T.cuda.is_available())
-                    trainer_min, min_checkpoint = create_trainer(r, gpu)
-                    trainer_max, max_checkpoint = create_trainer(r, gpu)
-                    print("\nTraining min model...")
-                    trainer_min.fit(m_min)
-                    ckpt = T.load(min_checkpoint.best_model_path)
-                    m_min.load_state_dict(ckpt['state_dict'])
-                    print("\nTraining max model...")
-                    trainer_max.fit(m_max)
-                    ckpt = T.load(max_checkpoint.best_model_path)
-                    m_max.load_state_dict(ckpt['state_dict'])
-
-                    results = metric.all_metrics_minmax(
-                        m_min.ctm, m_min.ncm, m_max.ncm, m_min.dat, m_min.cg_file, n=100000)
-                    print(results)
-
-                    # save results
-                    with open(f'{d}/{r}/results.json', 'w') as file:
-                        json.dump(results, file)
-                    T.save(m_min.state_dict(), f'{d}/{r}/best_min.th')
-                    T.save(m_max.state_dict(), f'{d}/{r}/best_max.th')
+            pending = id_pending(d, num_reruns)
+
+            # with n_jobs > 1, the min and max models of all pending reruns are fit concurrently;
+            # with replicas, they are fit together as stacked replicas in one process
+            together = (n_jobs > 1 or replicas) and pending
+            for group in ([pending] if together else [[r] for r in pending]):
+                models = {r: id_models(d, parameters, r, gen_model, dat, graph, n_epochs)
+                          for r in group}
+
+                # train models
+                if gpu is None:
+                    gpu = int(T.cuda.is_available())
+                print("\nTraining min and max models for runs {}...".format(group))
+                if replicas:
+                    from src.run.replica import ReplicaTrainer  # needs torch.func (torch >= 2.0)
+                    ReplicaTrainer(
+                        n_epochs, patience=NLLNCMMaxPipeline.patience,
+                        min_delta=NLLNCMMaxPipeline.min_delta, checkpoint_paths=[
+                            f'{d}/{r}/checkpoints/{name}/replica.ckpt'
+                            for r in group for name in ('min', 'max')
+                        ]).fit([m for r in group for m in models[r]])
                 else:
-                    print("Done with run {}.".format(r))
+                    fit_all([job for r in group for job in (
+                        (models[r][0], functools.partial(create_trainer, r, gpu, 'min', 0)),
+                        (models[r][1], functools.partial(create_trainer, r, gpu, 'max', 1)))],
+                        n_jobs=n_jobs, n_shards=n_shards)
+
+                for r in group:
+                    id_results(d, r, *models[r])
 
             T.save(dict(), f'{d}/best.th')  # breadcrumb file
             return True
         except Exception:
-            # move out/*/* to err/*/*/#
-            e = d.replace("out/", "err/").rsplit('-', 1)[0]
-            e_index = len(glob.glob(e + '/*'))
-            e += '/%s' % e_index
-            os.makedirs(e.rsplit('/', 1)[0], exist_ok=True)
-            shutil.move(d, e)
-            print(f'moved {d} to {e}')
+            move_to_err(d)
+            raise
+
+
+def run_id_packed(folder_name, graphs, n, dim, n_epochs, num_reruns,
+                  lockinfo=os.environ.get('SLURM_JOB_ID', ''), exact_sampling=False, counts=False):
+    '''
+    Like run_id for each (graph, graph_args, trial_index) in graphs, but with the min and max
+    models of every pending rerun of every graph trained in one ReplicaTrainer loop, without a
+    Lightning trainer, logger or checkpoint callback per model. Results are written to the same
+    per-graph output directories. Return the trial indices that were trained.
+    '''
+    with ExitStack() as stack:
+        jobs = []
+        try:
+            for graph, graph_args, trial_index in graphs:
+                parameters = id_parameters(graph_args, n, dim, n_epochs, trial_index)
+                d = 'out/IDExperiments/%s/%s' % (folder_name, parameters)
+                if not stack.enter_context(lock(f'{d}/lock', lockinfo)):
+                    print('[locked]', d)
+                    continue
+                if os.path.isfile(f'{d}/{num_reruns - 1}/best_max.th'):
+                    print('[done]', d)
+                    continue
+
+                print('[running]', d)
+                jobs.append((d, trial_index, {}))
+                gen_model, dat = id_data(d, parameters, graph, graph_args, n, dim,
+                                         exact_sampling=exact_sampling, counts=counts)
+                for r in id_pending(d, num_reruns):
+                    jobs[-1][2][r] = id_models(d, parameters, r, gen_model, dat, graph, n_epochs)
+
+            print("\nTraining min and max models for {} graphs...".format(len(jobs)))
+            from src.run.replica import ReplicaTrainer  # needs torch.func (torch >= 2.0)
+            ReplicaTrainer(
+                n_epochs, patience=NLLNCMMaxPipeline.patience,
+                min_delta=NLLNCMMaxPipeline.min_delta, checkpoint_paths=[
+                    f'{d}/{r}/checkpoints/{name}/replica.ckpt'
+                    for d, _, models in jobs for r in models for name in ('min', 'max')
+                ]).fit([m for _, _, models in jobs for pair in models.values() for m in pair])
+
+            for d, _, models in jobs:
+                for r, (m_min, m_max) in models.items():
+                    id_results(d, r, m_min, m_max)
+                T.save(dict(), f'{d}/best.th')  # breadcrumb file
+            return [trial_index for _, trial_index, _ in jobs]
+        except Exception:
+            for d, _, _ in jobs:
+                if os.path.isdir(d):
+                    move_to_err(d)
             raise
 
 
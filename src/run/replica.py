@@ -0,0 +1,135 @@
+import os
+
+import numpy as np
+import torch as T
+import torch.nn as nn
+from torch.func import functional_call, grad_and_value, stack_module_state, vmap
+
+
+class _Objective(nn.Module):
+    # a pipeline's objective as forward, so that functional_call can swap in replica parameters
+    def __init__(self, m):
+        super().__init__()
+        self.ncm = m.ncm
+        self.m = [m]  # not registered as a submodule
+
+    def forward(self, epoch, batch):
+        return self.m[0].objective(epoch, batch).sum()
+
+
+class ReplicaTrainer:
+    """
+    Trains K pipelines together in one optimizer loop.
+
+    Pipelines are grouped into replicas of the same objective: same class, maximize, data, NCM
+    architecture and objective hyperparameters (objective_attrs), since the objective's control
+    flow and constants must be shared within a vmap. Each step
+    stacks the NCM parameters of a group's active replicas and evaluates and differentiates all
+    of their objectives in one vmapped pass, drawing independent U samples per replica; each
+    replica then steps its own optimizer from configure_optimizers() (as with manual optimization
+    in Lightning, LR schedulers are not stepped). Pipelines for different graphs or data form
+    separate groups, so many small models can be packed into one process. Replicas are seeded by
+    their own initialization: seed before constructing each.
+
+    Like the Lightning trainers in src.run.pipeline, each replica stops early once its epoch loss
+    (the mean of its step losses) has not improved by min_delta for patience epochs (never if
+    patience is None), and its final state is saved to checkpoint_paths[i] as
+    {'state_dict': ...}. The objective must not checkpoint chunks (chunk_size None).
+    """
+
+    def __init__(self, max_epochs, patience=None, min_delta=0., checkpoint_paths=None,
+                 steps_per_epoch=None):
+        self.max_epochs = max_epochs
+        self.patience = patience
+        self.min_delta = min_delta
+        self.checkpoint_paths = checkpoint_paths
+        self.steps_per_epoch = steps_per_epoch  # None: one per data batch, as in Lightning
+        self.current_epoch = 0
+
+    @staticmethod
+    def _group_key(m):
+        shapes = tuple((k, tuple(v.shape)) for k, v in m.ncm.state_dict().items())
+        hparams = tuple(getattr(m, k) for k in m.objective_attrs)
+        return type(m), getattr(m, 'maximize', None), id(m.dat), shapes, hparams
+
+    def _step(self, ms, optims, epoch, batch):
+        params, buffers = stack_module_state([m.ncm for m in ms])
+        params = {'ncm.' + k: v.detach() for k, v in params.items()}
+        buffers = {'ncm.' + k: v for k, v in buffers.items()}
+        objective = _Objective(ms[0])
+
+        def loss(params, buffers):
+            return functional_call(objective, (params, buffers), (epoch, batch))
+
+        grads, losses = vmap(grad_and_value(loss), randomness='different')(params, buffers)
+        for j, (m, opt) in enumerate(zip(ms, optims)):
+            opt.zero_grad()
+            for k, p in m.ncm.named_parameters():
+                p.grad = grads['ncm.' + k][j].to(p.dtype)
+            opt.step()
+        return losses.tolist()
+
+    def save_checkpoint(self, m, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        T.save({'epoch': self.current_epoch, 'state_dict': m.state_dict()}, path)
+
+    def fit(self, pipelines):
+        """Train all pipelines; return each replica's mean step loss in its last epoch."""
+        for m in pipelines:
+            assert m.chunk_size is None, 'checkpointed chunks cannot be vmapped'
+        k = len(pipelines)
+        paths = self.checkpoint_paths or [None] * k
+        optims = [cfg['optimizer'] if isinstance(cfg, dict) else cfg
+                  for cfg in (m.configure_optimizers() for m in pipelines)]
+        groups = {}
+        for i, m in enumerate(pipelines):
+            groups.setdefault(self._group_key(m), []).append(i)
+        groups = list(groups.values())
+        loaders = [pipelines[idx[0]].train_dataloader() for idx in groups]
+        batches = [iter(()) for _ in groups]
+
+        best = [np.inf] * k
+        wait = [0] * k
+        last = [np.nan] * k
+        active = list(range(k))
+        for m in pipelines:
+            m.train()
+        for epoch in range(self.max_epochs):
+            if not active:
+                break
+            self.current_epoch = epoch
+            epoch_loss = [0.] * k
+            for g, idx in enumerate(groups):
+                idx = [i for i in idx if i in active]
+                if not idx:
+                    continue
+                n_steps = self.steps_per_epoch or len(loaders[g])
+                for _ in range(n_steps):
+                    batch = None
+                    if pipelines[idx[0]].minibatch:
+                        batch = next(batches[g], None)
+                        if batch is None:
+                            batches[g] = iter(loaders[g])
+                            batch = next(batches[g])
+                    losses = self._step([pipelines[i] for i in idx], [optims[i] for i in idx],
+                                        epoch, batch)
+                    for i, l in zip(idx, losses):
+                        epoch_loss[i] += l / n_steps
+
+            for i in list(active):
+                last[i] = epoch_loss[i]
+                if epoch_loss[i] < best[i] - self.min_delta:
+                    best[i] = epoch_loss[i]
+                    wait[i] = 0
+                else:
+                    wait[i] += 1
+                stop = self.patience is not None and wait[i] >= self.patience
+                if np.isnan(epoch_loss[i]) or stop:
+                    active.remove(i)
+                    if paths[i] is not None:
+                        self.save_checkpoint(pipelines[i], paths[i])
+
+        for i in active:
+            if paths[i] is not None:
+                self.save_checkpoint(pipelines[i], paths[i])
+        return last
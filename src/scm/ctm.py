@@ -1,8 +1,10 @@
 import itertools
 
+import numpy as np
 import torch as T
 
 from .distribution import FactorizedDistribution
+from .inference import FactorGraph
 from .scm import SCM
 
 RPA = {
@@ -450,6 +452,8 @@ RPA = {
 
 
 class CTM(SCM):
+    max_table_size = 2 ** 20  # largest joint table sample_table will build
+
     def __init__(self, cg_file=None, rpa=None, v_size={}):
         assert (cg_file is None) != (rpa is None)
         if cg_file is not None:
@@ -472,17 +476,54 @@ class CTM(SCM):
 
         v = list(self.r)
         pu = FactorizedDistribution(self.r.values(), cond=self.cond)
-        f = {vi: lambda v, u, vi=vi, r=self.r, rpa=self.rpa:
-             (T.cat([u[ui] for ui in self.r[vi]], dim=-1)
-              .reshape((u[self.r[vi][0]].shape[0],)
-                       + (2,) * len(self.r[vi][0][1]))[
-                  (T.arange(u[self.r[vi][0]].shape[0]),)
-                  + tuple(
-                      (v[k] if isinstance(k, str) else u[k]).flatten()
-                      for k, _ in self.r[vi][0][1]
-                  )]).view(-1, 1) for vi in v}
+        f = {vi: self._compile_mechanism(self.r[vi]) for vi in v}
 
         super().__init__(v, f, pu)
+        self.mechanisms = {vi: self._mechanism_factors(vi) for vi in v}
+        self.elimination_orders = {}
+        self.tables = {}
+
+    @staticmethod
+    def _compile_mechanism(us):
+        # us[i] is the response variable read when the parent bits, most significant first,
+        # spell i; parent values are folded into that offset with precomputed strides and the
+        # response variables are read with a single gather
+        pa = [k for k, _ in us[0][1]]
+        strides = [2 ** (len(pa) - 1 - i) for i in range(len(pa))]
+
+        def f(v, u):
+            packed = T.cat([u[ui] for ui in us], dim=-1)  # (n, 2 ** len(pa))
+            offset = T.zeros_like(packed[:, :1])
+            for k, stride in zip(pa, strides):
+                offset = offset + v[k].long().view(-1, 1) * stride
+            return packed.gather(-1, offset)
+        return f
+
+    def _mechanism_factors(self, vi):
+        # vi equals response variable (vi, pa) whenever its parents take the values pa, so the
+        # deterministic mechanism factorizes into one small indicator factor per response variable
+        factors = []
+        for ui in self.r[vi]:
+            pa = tuple(k for k, _ in ui[1])
+            t = T.ones((2,) * (len(pa) + 2), dtype=T.float64)
+            for x in (0, 1):
+                t[(x,) + tuple(val for _, val in ui[1]) + (1 - x,)] = 0
+            factors.append(((vi,) + pa + (ui,), t))
+        return factors
+
+    def factor_graph(self, do={}):
+        device = self.device_param.device
+        g = FactorGraph()
+        for us in self.pu.us:
+            cond = self.pu.cond[us]
+            q = self.pu.q[str(us)]
+            g.add(tuple(cond) + tuple(us),
+                  T.softmax(q.double().reshape(2 ** len(cond), -1), dim=-1).reshape(q.shape))
+        for vi in self.v:
+            if vi not in do:
+                for scope, t in self.mechanisms[vi]:
+                    g.add(scope, t.to(device))
+        return g
 
     def pmf(self, v, do={}, cond={}):
         pmf = T.exp(self.log_pmf(v, do, cond))
@@ -500,15 +541,64 @@ class CTM(SCM):
                   T.tensor(0.))
         return pmf if self.training else pmf.item()
 
+    def table(self, do={}, select=None):
+        """
+        P(select | do) as a tensor with one dimension of size 2 per variable in select.
+
+        select defaults to all variables not intervened on, in the order of self.v, so that the
+        flattened table lines up with self.space(). Tables are computed in a single variable
+        elimination pass. Without gradients, they are cached per (do, select) and recomputed
+        whenever a parameter is updated; with gradients, each call builds a fresh graph.
+        """
+        do = {k: int(val) for k, val in do.items()}
+        if select is None:
+            select = [k for k in self.v if k not in do]
+        select = tuple(select)
+        assert set(select).isdisjoint(do)
+
+        key = (tuple(sorted(do.items())), select, self.device_param.device)
+        version = tuple(p._version for p in self.parameters())
+        cached = not T.is_grad_enabled()
+        if not cached or key not in self.tables or self.tables[key][0] != version:
+            g = self.factor_graph(do).condition(do)
+            order_key = (frozenset(do), select)
+            if order_key not in self.elimination_orders:
+                self.elimination_orders[order_key] = g.elimination_order(keep=select)
+            t = g.eliminate(keep=select, order=self.elimination_orders[order_key]).float()
+            if not cached:
+                return t
+            self.tables[key] = (version, t)
+        return self.tables[key][1]
+
+    def sample_table(self, n, counts=False):
+        """
+        Draw n samples of V exactly from the joint table P(V) by inverse-CDF sampling.
+
+        With counts=True, return the number of samples of each configuration (aligned with
+        self.space()) instead, drawn in one multinomial without materializing any rows.
+        """
+        assert 2 ** len(self.v) <= self.max_table_size, 'joint table too large'
+        device = self.device_param.device
+        with T.no_grad():
+            pv = self.table().flatten().double().clamp(min=0)
+            pv = pv / pv.sum()
+            if counts:
+                return T.tensor(np.random.multinomial(n, pv.cpu().numpy()), device=device)
+
+            codes = T.searchsorted(pv.cumsum(dim=0), T.rand(n, dtype=T.float64, device=device))
+            codes = codes.clamp(max=len(pv) - 1)[:, None]
+            return {k: (codes >> (len(self.v) - 1 - i)) & 1 for i, k in enumerate(self.v)}
+
     def log_pmf(self, v, do={}, cond={}):
         if cond:
             assert set(v).isdisjoint(cond)
             return (self.log_pmf(dict(v, **cond), do=do)
                     - self.log_pmf(cond, do=do))
 
-        def _compare(v1, v2):
-            return (all(v1[k] == v2[k].item() for k in v1))
-        pmf = T.cat([self.pu.log_pmf(u)
-                     for u in self.pu.space()
-                     if _compare(v, self(u=u, do=do))], dim=-1)
-        return T.logsumexp(pmf, dim=-1, keepdim=True)
+        for k, val in v.items():
+            if k in do and int(do[k]) != int(val):
+                return T.full((1, 1), float('-inf'), device=self.device_param.device)
+
+        select = [k for k in self.v if k in v and k not in do]
+        pv = self.table(do=do, select=select)[tuple(int(v[k]) for k in select)]
+        return T.log(pv).reshape(1, 1)
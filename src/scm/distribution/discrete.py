@@ -50,35 +50,32 @@ class FactorizedDistribution(DiscreteDistribution):
     def sample(self, n=1, device=None):
         if device is None:
             device = self.device_param.device
-        qs = {u: (self.q[str(u)][None].to(device)
-                  + -T.log(-T.log(T.rand((n,) + tuple(self.q[str(u)].shape),
-                                         device=device))))
-              for u in self.us}
         qs = {}
-        for us in self.us:
-            t = self.q[str(us)]
-
-            # select conditional probability distribution
-            if self.cond[us]:
-                t = t[tuple(qs[u2].flatten() for u2 in self.cond[us])]
-            else:
-                t = t.expand((n,) + tuple(t.shape))
-
-            # sample using Gumbel-max
-            for i in range(10):  # in case there are two maximums in one row
-                # Gumbel-max
-                gm = t + -T.log(-T.log(T.rand(t.shape, device=device)))
-                gm = ((gm == (gm.view(n, -1).max(dim=1).values
-                              .reshape((n,) + (1,) * (len(gm.shape) - 1))))
-                      .nonzero(as_tuple=False)[:, 1:])
-                if len(gm) == n:
-                    break
-            else:
-                raise ValueError(
-                    f'something went wrong! gm has shape {gm.shape}')
-
-            # split samples into variables
-            qs.update({us[i]: gm[:, i:i+1] for i in range(len(us))})
+        with T.no_grad():
+            for us in self.us:
+                cond = self.cond[us]
+                k = 2 ** len(us)
+
+                # CDF of each conditional distribution, offset by its row index so that the
+                # flattened table is a single sorted sequence (2 ** len(cond) * k,)
+                rows = T.arange(2 ** len(cond), device=device, dtype=T.float64)
+                cdf = (T.softmax(self.q[str(us)].to(device).double().reshape(len(rows), k), dim=-1)
+                       .cumsum(dim=-1) + rows[:, None]).flatten()
+
+                # select conditional probability distribution (n,)
+                if cond:
+                    strides = T.tensor([2 ** (len(cond) - 1 - i) for i in range(len(cond))],
+                                       device=device)
+                    row = (T.cat([qs[u2] for u2 in cond], dim=-1) * strides).sum(dim=-1)
+                else:
+                    row = T.zeros(n, dtype=T.long, device=device)
+
+                # inverse-CDF sampling of the flat index of us within its row (n, 1)
+                i = T.searchsorted(cdf, row + T.rand(n, device=device, dtype=T.float64))
+                i = (i - row * k).clamp(0, k - 1)[:, None]
+
+                # split samples into variables
+                qs.update({us[j]: (i >> (len(us) - 1 - j)) & 1 for j in range(len(us))})
         return qs
 
     def log_pmf(self, u):
@@ -99,24 +96,67 @@ class FactorizedDistribution(DiscreteDistribution):
             yield dict(pairs)
 
 
+def pack_bits(x):
+    """Pack an (n, w) tensor of 0/1 values into an (ceil(n / 64), w) int64 tensor of words."""
+    n, w = x.shape
+    words = x.new_zeros(-(-n // 64) * 64, w, dtype=T.long)
+    words[:n] = x.long()
+    shifts = T.arange(64, device=x.device).view(1, 64, 1)
+    return (words.view(-1, 64, w) << shifts).sum(dim=1)
+
+
+def unpack_bits(words, n):
+    """Inverse of pack_bits: an (n, w) LongTensor of 0/1 values."""
+    shifts = T.arange(64, device=words.device).view(1, 64, 1)
+    return ((words.unsqueeze(1) >> shifts) & 1).reshape(-1, words.shape[1])[:n]
+
+
 class BernoulliDistribution(DiscreteDistribution):
+    precision = 32
+
     def __init__(self, u_names, sizes, p, seed=None):
         assert set(sizes.keys()).issubset(set(u_names))
 
         super().__init__(list(u_names))
         self.sizes = {U: sizes[U] if U in sizes else 1 for U in u_names}
         self.p = p
+        self.generator = T.Generator()
         if seed is not None:
-            self.rand_state = np.random.RandomState(seed=seed)
+            self.generator.manual_seed(seed)
         else:
-            self.rand_state = np.random.RandomState()
+            self.generator.seed()
 
-    def sample(self, n=1, device=None):
+    def random_words(self, shape):
+        lo, hi = (T.randint(0, 2 ** 32, shape, generator=self.generator) for _ in range(2))
+        return (hi << 32) | lo
+
+    def sample_packed(self, n=1, device=None):
+        """
+        Sample n values of each U as packed words (see pack_bits), 64 samples per word.
+
+        Each bit is Bernoulli(p) with p rounded to `precision` binary digits: going from the
+        least to the most significant digit of p, a uniform word is OR-ed in for a 1 (halving
+        the probability of a 0) and AND-ed in for a 0 (halving the probability of a 1).
+        """
         if device is None:
             device = self.device_param.device
-
+        digits = round(self.p * 2 ** self.precision)
+        # binary digits of p from its least significant 1 up to the 2 ** -1 digit
+        lowest = max((digits & -digits).bit_length() - 1, 0)
+        bits = [(digits >> i) & 1 for i in range(lowest, self.precision)]
         u_vals = dict()
         for U in self.sizes:
-            u_vals[U] = T.from_numpy(self.rand_state.binomial(1, self.p, size=(n, self.sizes[U]))).long().to(device)
-
+            shape = (-(-n // 64), self.sizes[U])
+            if digits >= 2 ** self.precision:
+                values = T.full(shape, -1, dtype=T.long)
+            else:
+                values = T.zeros(shape, dtype=T.long)
+                if digits > 0:
+                    for bit in bits:
+                        words = self.random_words(shape)
+                        values = (values | words) if bit else (values & words)
+            u_vals[U] = values.to(device)
         return u_vals
+
+    def sample(self, n=1, device=None):
+        return {U: unpack_bits(values, n) for U, values in self.sample_packed(n, device).items()}
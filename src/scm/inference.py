@@ -0,0 +1,91 @@
+import itertools
+import string
+
+import torch as T
+
+
+def _contract(factors, keep):
+    # multiply factors and sum out every variable not in keep, in a single einsum
+    letters = {}
+    for scope, _ in factors:
+        for k in scope:
+            letters.setdefault(k, string.ascii_letters[len(letters)])
+    assert all(k in letters for k in keep), (keep, list(letters))
+    tensors = [t for scope, t in factors if scope]
+    scalar = 1
+    for scope, t in factors:
+        if not scope:
+            scalar = scalar * t
+    if not tensors:
+        return scalar
+    lhs = ','.join(''.join(letters[k] for k in scope) for scope, _ in factors if scope)
+    rhs = ''.join(letters[k] for k in keep)
+    return T.einsum(f'{lhs}->{rhs}', *tensors) * scalar
+
+
+class FactorGraph:
+    """
+    Factor graph over binary variables with exact inference by variable elimination.
+
+    Each factor is a (scope, table) pair, where scope is a tuple of variable names and table is a
+    tensor with one dimension of size 2 per variable in scope. Tables may require gradients.
+    """
+
+    def __init__(self, factors=()):
+        self.factors = list(factors)
+
+    def add(self, scope, table):
+        self.factors.append((tuple(scope), table))
+
+    def variables(self):
+        return list(dict.fromkeys(k for scope, _ in self.factors for k in scope))
+
+    def condition(self, evidence):
+        """Return the factor graph with the variables in evidence fixed to the given values."""
+        return FactorGraph(
+            (tuple(k for k in scope if k not in evidence),
+             table[tuple(evidence.get(k, slice(None)) for k in scope)])
+            for scope, table in self.factors)
+
+    def elimination_order(self, keep=()):
+        """Greedy min-fill order (ties broken by degree) over all variables not in keep."""
+        adj = {k: set() for k in self.variables()}
+        for scope, _ in self.factors:
+            for k in scope:
+                adj[k].update(scope)
+                adj[k].discard(k)
+
+        def fill(k):
+            return sum(1 for a, b in itertools.combinations(adj[k], 2) if b not in adj[a])
+
+        order = []
+        remaining = set(adj).difference(keep)
+        while remaining:
+            k = min(remaining, key=lambda k: (fill(k), len(adj[k]), str(k)))
+            for a in adj[k]:
+                adj[a].update(adj[k])
+                adj[a].discard(a)
+                adj[a].discard(k)
+            del adj[k]
+            remaining.remove(k)
+            order.append(k)
+        return order
+
+    def eliminate(self, keep=(), order=None):
+        """
+        Sum out all variables not in keep.
+
+        Returns a tensor with one dimension per variable in keep (in the given order), or a
+        scalar if keep is empty.
+        """
+        if order is None:
+            order = self.elimination_order(keep)
+        factors = list(self.factors)
+        for k in order:
+            related = [f for f in factors if k in f[0]]
+            if not related:
+                continue
+            factors = [f for f in factors if k not in f[0]]
+            scope = tuple(dict.fromkeys(k2 for s, _ in related for k2 in s if k2 != k))
+            factors.append((scope, _contract(related, scope)))
+        return _contract(factors, tuple(keep))
@@ -1,12 +1,17 @@
+import functools
+
 import numpy as np
 import torch
 
 from src.scm import SCM
 from src.ds.causal_graph import CausalGraph
 from src.scm.distribution import BernoulliDistribution
+from src.scm.distribution.discrete import pack_bits, unpack_bits
 
 
 class XORModel(SCM):
+    max_table_size = 2 ** 20
+
     def __init__(self, cg, dim=1, p=0.5, seed=None):
         self.cg = cg
         self.dim = dim
@@ -25,6 +30,7 @@ class XORModel(SCM):
             self.confounders[V1].append(conf_name)
             self.confounders[V2].append(conf_name)
             sizes[conf_name] = 1
+        self.sizes = sizes
 
         super().__init__(
             v=list(cg),
@@ -45,13 +51,126 @@ class XORModel(SCM):
                 if values.shape[1] >= par_samp.shape[1]:
                     values = torch.bitwise_xor(values, par_samp)
                 else:
-                    par_samp = torch.unsqueeze(torch.remainder(torch.sum(par_samp, 1), 2), 1)
+                    # parity by XOR-reduction, which also works on packed words
+                    par_samp = torch.unsqueeze(
+                        functools.reduce(torch.bitwise_xor, par_samp.unbind(1)), 1)
                     values = torch.bitwise_xor(values, par_samp)
 
             return values
 
         return xor_func
 
+    def forward(self, n=None, u=None, do={}, select=None, packed=True):
+        """
+        Samples are generated bit-packed by default: the noise is drawn as 64-bit words and the
+        mechanisms are evaluated word-wise, so every XOR handles 64 samples at once. Values are
+        unpacked to (n, width) tensors only on return.
+        """
+        if not packed or u is not None:
+            return super().forward(n=n, u=u, do=do, select=select)
+        device = self.device_param.device
+        do = {k: pack_bits(val.long().expand(n, -1) if len(val) == 1 else val.long()).to(device)
+              for k, val in do.items()}
+        v = super().forward(u=self.pu.sample_packed(n), do=do, select=select)
+        return {k: unpack_bits(val, n) for k, val in v.items()}
+
+    def linear_system(self, do={}, select=None):
+        """
+        Compile the XOR mechanisms into an affine system over GF(2).
+
+        Returns a list with one (mask, const) pair per bit of the selected variables, where bit
+        j of mask is set if noise bit j (in pu order) enters the output bit, and const is the
+        value of the bit when all noise bits are 0.
+        """
+        if select is None:
+            select = self.v
+        offsets = dict()
+        m = 0
+        for U in self.pu.sizes:
+            offsets[U] = m
+            m += self.pu.sizes[U]
+
+        v = dict()
+        for V in self.v:
+            if V in do:
+                vals = torch.as_tensor(do[V]).flatten().long().tolist()
+                if len(vals) == 1:
+                    vals = vals * self.sizes[V]
+                assert len(vals) == self.sizes[V], (V, vals)
+                v[V] = [(0, val & 1) for val in vals]
+                continue
+
+            # mirrors xor_func: own noise, broadcast confounders, then parents either bitwise
+            # (or broadcast) or, if wider than V, through their parity
+            values = [(1 << (offsets[V] + i), 0) for i in range(self.sizes[V])]
+            for conf in self.confounders[V]:
+                values = [(mask ^ (1 << offsets[conf]), c) for mask, c in values]
+            for par in self.cg.pa[V]:
+                par_bits = v[par]
+                if len(values) < len(par_bits):
+                    mask, c = 0, 0
+                    for mask2, c2 in par_bits:
+                        mask, c = mask ^ mask2, c ^ c2
+                    par_bits = [(mask, c)]
+                if len(par_bits) == 1:
+                    par_bits = par_bits * len(values)
+                values = [(mask ^ mask2, c ^ c2)
+                          for (mask, c), (mask2, c2) in zip(values, par_bits)]
+            v[V] = values
+
+        return [bit for V in select for bit in v[V]]
+
+    def table(self, do={}, select=None):
+        """
+        Exact P(select | do) as a tensor with one dimension of size 2 per selected bit.
+
+        With V = c + A u over GF(2) and iid Bernoulli(p) noise u, the characteristic function of
+        A u at s is (1 - 2p) ** wt(A^T s), so P(V) is its Walsh-Hadamard transform.
+        """
+        bits = self.linear_system(do, select)
+        d = len(bits)
+        assert 2 ** d <= self.max_table_size, 'joint table over %d bits is too large' % d
+        device = self.device_param.device
+
+        # weight of A^T s for all s: column j of A contributes the parity of s & col_j
+        cols = dict()
+        const = 0
+        for r, (mask, c) in enumerate(bits):
+            const |= c << (d - 1 - r)
+            j = 0
+            while mask:
+                if mask & 1:
+                    cols[j] = cols.get(j, 0) | 1 << (d - 1 - r)
+                mask >>= 1
+                j += 1
+        s = torch.arange(2 ** d, device=device)
+        weight = torch.zeros(2 ** d, dtype=torch.float64, device=device)
+        for col in cols.values():
+            x = s & col
+            for shift in (32, 16, 8, 4, 2, 1):
+                x = x ^ (x >> shift)
+            weight += x & 1
+        t = torch.pow(torch.tensor(1 - 2 * self.p, dtype=torch.float64, device=device), weight)
+
+        # fast Walsh-Hadamard transform
+        h = 1
+        while h < 2 ** d:
+            t = t.view(-1, 2, h)
+            t = torch.stack((t[:, 0] + t[:, 1], t[:, 0] - t[:, 1]), dim=1)
+            h *= 2
+        t = t.flatten() / 2 ** d
+
+        # shift by the constant term and clamp round-off
+        t = t[s ^ const].clamp(min=0)
+        return t.reshape((2,) * d).float()
+
+    def pmf(self, v, do={}):
+        """Exact P(v | do), where v maps (a subset of) the variables to their values."""
+        select = [k for k in self.v if k in v]
+        index = tuple(b for k in select
+                      for b in torch.as_tensor(v[k]).flatten().long().tolist())
+        return self.table(do, select)[index].item()
+
 
 if __name__ == "__main__":
     cg = CausalGraph.read("../../dat/cg/frontdoor.cg")
@@ -1,6 +1,7 @@
 import numpy as np
 import torch as T
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from .distribution import UniformDistribution
 from .nn import Simple
@@ -24,29 +25,61 @@ class NCM(SCM):
                 for k in cg}),
             pu=UniformDistribution(self.cg.c2))
 
-    def biased_nll(self, v, n=1, do={}):
+    def _log_pv(self, v, u, do={}):
+        logpv = 0
+        for k in self.v:
+            if k not in do:
+                logpv += self.f[k](v, u, v[k])
+        return logpv
+
+    def _chunked_logsumexp(self, f, n, chunk_size):
+        """
+        Streaming logsumexp of f over n U samples, evaluated chunk_size samples at a time.
+
+        f(c, device_param) must draw c fresh U samples and return the logsumexp of log P(v | u)
+        over them. When gradients are enabled, each chunk is checkpointed: only its logsumexp is
+        kept, and its U samples (replayed from the saved RNG state) and mechanism activations are
+        recomputed one chunk at a time during backward, so peak memory does not depend on n.
+        """
+        lse = None
+        for s in range(0, n, chunk_size):
+            c = min(chunk_size, n - s)
+            if T.is_grad_enabled():
+                # device_param is passed so that the RNG state of its device is preserved
+                t = checkpoint(f, c, self.device_param, use_reentrant=False)
+            else:
+                t = f(c, self.device_param)
+            lse = t if lse is None else T.logaddexp(lse, t)
+        return lse
+
+    def biased_nll(self, v, n=1, do={}, chunk_size=None):
         assert not set(do.keys()).difference(self.v)
         mode = self.training
         try:
             self.train()
             batch_size = len(next(iter(v.values())))
-            u = {k: t.expand((batch_size,) + tuple(t.shape)).transpose(0, 1)
-                 for k, t in self.pu.sample(n=n).items()}  # (n, batch_size, var_size)
-            v_new = {k: t.expand((n,) + t.shape).float()
-                     for k, t in v.items()}
-            logpv = 0
             for k in self.v:
-                if k in do:
-                    if do[k] != v[k]:
-                        return float('-inf')
-                else:
-                    logpv += self.f[k](v_new, u, v_new[k])
-            logpv = T.logsumexp(logpv, dim=0) - np.log(n)
+                if k in do and do[k] != v[k]:
+                    return float('-inf')
+
+            def lse(c, _):
+                u = {k: t.expand((batch_size,) + tuple(t.shape)).transpose(0, 1)
+                     for k, t in self.pu.sample(n=c).items()}  # (c, batch_size, var_size)
+                v_new = {k: t.expand((c,) + t.shape).float()
+                         for k, t in v.items()}
+                return T.logsumexp(self._log_pv(v_new, u, do), dim=0)
+
+            if chunk_size is None or chunk_size >= n:
+                logpv = lse(n, None)
+            else:
+                logpv = self._chunked_logsumexp(lse, n, chunk_size)
+            logpv = logpv - np.log(n)
             return -logpv
         finally:
             self.train(mode=mode)
 
-    def nll(self, v, n=1, do={}, m=100000, alpha=80, return_biased=False):
+    def nll(self, v, n=1, do={}, m=100000, alpha=80, return_biased=False, chunk_size=None,
+            reduce=True):
         r"""
         Uses the SUMO / Russian roulette estimator to compute an unbiased estimate of NLL.
 
@@ -99,6 +132,16 @@ class NCM(SCM):
 
         return_biased : bool, default=False
             Whether or not to return (estimate, biased_estimate) as a tuple, or just the estimate.
+
+        chunk_size : int, default=None
+            If set, the first $m - 1$ samples of each SUMO estimator are evaluated chunk_size at a
+            time with a streaming logsumexp (see `_chunked_logsumexp`), so that peak memory is
+            independent of m. The remaining $K$ samples are evaluated at once.
+
+        reduce : bool, default=True
+            Whether to average the n SUMO estimates for each sample in v, or to return all of them
+            as a (batch_size, n) tensor. The n estimates are independent, so their spread gives the
+            standard error of the average from a single pass.
         """
         assert not set(do.keys()).difference(self.v)
         mode = self.training
@@ -112,6 +155,19 @@ class NCM(SCM):
                          np.floor(1 / uk),
                          np.floor(np.log(alpha * uk) / np.log(0.9) + alpha))
 
+            for k in self.v:
+                if k in do and do[k] != v[k]:
+                    return float('-inf')
+
+            # compute weights (max_n_samples - m + 1,)
+            ik = np.arange(K.max())
+            ipk = T.tensor(np.where(ik < alpha, ik, alpha * 0.9 ** (alpha - ik)),
+                           device=self.device_param.device)
+
+            if chunk_size is not None:
+                return self._chunked_sumo(v, K.astype(int), m, ipk, do, chunk_size,
+                                          return_biased, reduce)
+
             # compute log probabilities (batch_size, max_sum_n_samples)
             n_samples = K + (m - 1)
             max_sum_n_samples = int(n_samples.sum(axis=1).max())
@@ -120,21 +176,10 @@ class NCM(SCM):
             v_new = {k: t.expand((max_sum_n_samples,) + t.shape).transpose(0, 1)
                      for k, t in v.items()}
 
-            logpv = 0
-            for k in self.v:
-                if k in do:
-                    if do[k] != v[k]:
-                        return float('-inf')
-                else:
-                    logpv += self.f[k](v_new, u, v_new[k])
+            logpv = self._log_pv(v_new, u, do)
             assert tuple(logpv.shape) == (batch_size, max_sum_n_samples), \
                 (logpv.shape, batch_size, max_sum_n_samples)
 
-            # compute weights (max_n_samples - m + 1,)
-            ik = np.arange(K.max())
-            ipk = T.tensor(np.where(ik < alpha, ik, alpha * 0.9 ** (alpha - ik)),
-                           device=self.device_param.device)
-
             # compute SUMO given samples (batch_size, n)
             indices = np.pad(n_samples, [(0, 0), (1, 0)]).cumsum(axis=1).astype(int)
             assert (np.diff(indices) > 0).all()
@@ -148,16 +193,54 @@ class NCM(SCM):
                     vals = vals[m-1:]
                     estimates[i][j] = vals[0] + (T.diff(vals) * ipk[:len(vals)-1]).sum()
 
-            # return empirical mean of SUMO estimates per sample (batch_size,)
+            # return empirical mean of SUMO estimates per sample (batch_size,), or all of them
+            nll = -estimates.mean(dim=1) if reduce else -estimates
             if return_biased:
-                return (-estimates.mean(dim=1),
+                return (nll,
                         T.logsumexp(logpv.flatten(), dim=0) - T.log(T.tensor(logpv.numel())))
             else:
-                return -estimates.mean(dim=1)
+                return nll
         finally:
             self.train(mode=mode)
 
-    def nll_marg(self, v, n=1, m=10000, do={}, return_biased=False):
+    def _chunked_sumo(self, v, K, m, ipk, do, chunk_size, return_biased, reduce=True):
+        batch_size, n = K.shape
+        device = self.device_param.device
+        estimates = []
+        biased = []
+        for i in range(batch_size):
+            v_i = {k: t[i] for k, t in v.items()}
+
+            def lse(c, _):
+                v_new = {k: t.expand((c,) + t.shape) for k, t in v_i.items()}
+                return T.logsumexp(self._log_pv(v_new, self.pu.sample(n=c), do), dim=0)
+
+            for j in range(n):
+                k_ij = int(K[i, j])
+
+                # log-sum-exp of the first m - 1 samples, streamed in chunks
+                if m > 1:
+                    prefix = self._chunked_logsumexp(lse, m - 1, chunk_size)
+                else:
+                    prefix = T.tensor(float('-inf'), device=device)
+
+                # the K samples that enter the Russian roulette terms
+                v_new = {k: t.expand((k_ij,) + t.shape) for k, t in v_i.items()}
+                tail = self._log_pv(v_new, self.pu.sample(n=k_ij), do)
+                vals = (T.logaddexp(prefix, T.logcumsumexp(tail, dim=0))
+                        - T.log(T.arange(k_ij, device=device) + m))
+                estimates.append(vals[0] + (T.diff(vals) * ipk[:len(vals)-1]).sum())
+                biased.append(T.logaddexp(prefix, T.logsumexp(tail, dim=0)))
+        estimates = T.stack(estimates).reshape(batch_size, n)
+
+        nll = -estimates.mean(dim=1) if reduce else -estimates
+        if return_biased:
+            return (nll,
+                    T.logsumexp(T.stack(biased), dim=0) - np.log(int((K + (m - 1)).sum())))
+        else:
+            return nll
+
+    def nll_marg(self, v, n=1, m=10000, do={}, return_biased=False, chunk_size=None):
         assert not set(v.keys()).difference(self.v)
         assert not set(do.keys()).difference(self.v)
 
@@ -171,7 +254,7 @@ class NCM(SCM):
             v_joined.update(v)
             v_joined.update(do)
             #nll_all, biased_nll = self.nll(v_joined, n=n, m=m, do=do, return_biased=return_biased)
-            nll_all = self.biased_nll(v_joined, n=m, do=do)
+            nll_all = self.biased_nll(v_joined, n=m, do=do, chunk_size=chunk_size)
             biased_nll = 0
             pv += T.exp(-nll_all)
             if return_biased:
@@ -27,6 +27,12 @@ class Simple(nn.Module):
             T.nn.init.xavier_normal_(m.weight,
                                      gain=T.nn.init.calculate_gain('relu'))
 
+    def logits(self, i):
+        # the MADE may run under (bf16) autocast; the likelihood path is kept in float32
+        o = self.nn[0](i)
+        with T.autocast(device_type=o.device.type, enabled=False):
+            return self.nn[1](o.float())
+
     def forward(self, pa, u, v=None, n=None):
         # confirm sampling / pmf estimation
         assert n is None or v is None, 'v and n may not both be set'
@@ -48,11 +54,10 @@ class Simple(nn.Module):
             i = T.cat([pa[k] for k in self.v]
                       + [u[k] for k in self.u]
                       + [v], dim=-1)
-            o = self.nn(i)
+            o = self.logits(i)
             o = o[..., -self.o_size:]
             o = T.where(v == 1, o, T.log(1 - 0.9999998 * T.exp(o) - 0.0000001))
-            if (o >= 0).any():
-                o[o >= 0] = -T.relu(-o[o >= 0]) - 0.0000001
+            o = T.where(o >= 0, -T.relu(-o) - 0.0000001, o)  # no data-dependent branch, for vmap
             return o.sum(dim=-1)
         else:  # sample from P(V)
             if self.u:
@@ -70,7 +75,7 @@ class Simple(nn.Module):
             o_acc = T.zeros(o_shape, device=self.device_param.device)  # (n, d)
             for d in range(self.o_size):
                 i = T.cat([ib, o_acc], dim=-1)  # (n, dvu + d)
-                o = self.nn(i)  # (n, dvu + d)
+                o = self.logits(i)  # (n, dvu + d)
                 o = o[..., ib.shape[-1] + d: ib.shape[-1] + d + 1]  # (n, 1)
                 o = T.cat([T.log(1 - T.exp(o)), o], dim=-1)  # (n, 2)
                 assert tuple(o.shape) == tuple(o_shape[:-1]) + (2,), (o.shape, o_shape)  # (n, d)
@@ -0,0 +1,31 @@
+import os
+from types import SimpleNamespace
+
+import torch as T
+
+from src.run.checkpoint import BackgroundWriter, ThrottledCheckpointIO
+from src.run.pipeline import flush_checkpoints
+
+
+def test_writer_coalesces_and_flushes(tmp_path):
+    path = str(tmp_path / 'a.ckpt')
+    writer = BackgroundWriter(min_interval=3600.)
+    writer.submit({'x': T.zeros(1)}, str(tmp_path / 'first.ckpt'))  # written at once
+    writer.flush()
+    x = T.zeros(1)
+    writer.submit({'x': x}, path)
+    x += 1  # the submitted snapshot is not affected
+    writer.submit({'x': x * 2}, path)
+    assert not os.path.isfile(path)  # throttled
+    writer.flush()
+    assert T.load(path)['x'].item() == 2
+    assert not os.path.isfile(path + '.tmp')
+
+
+def test_flush_checkpoints_before_reading_best(tmp_path):
+    checkpoint_io = ThrottledCheckpointIO(min_interval=3600.)
+    trainer = SimpleNamespace(strategy=SimpleNamespace(checkpoint_io=checkpoint_io))
+    for i in range(2):  # the second save waits for the interval
+        checkpoint_io.save_checkpoint({'epoch': i}, tmp_path / f'epoch={i}.ckpt')
+    flush_checkpoints(trainer)
+    assert T.load(tmp_path / 'epoch=1.ckpt')['epoch'] == 1
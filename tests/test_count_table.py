@@ -0,0 +1,48 @@
+import torch as T
+
+from src.ds import CountTable, ProbabilityTable
+
+
+def samples(n, sizes):
+    return {k: T.randint(0, 2, (n, w)) for k, w in sizes.items()}
+
+
+def sorted_rows(dat):
+    rows = T.cat([v.long() for v in dat.values()], dim=1)
+    return T.unique(rows, dim=0, return_counts=True)
+
+
+def test_round_trip():
+    T.manual_seed(0)
+    for sizes in ({'X': 1, 'Z': 2, 'Y': 1}, {'X': 1, 'Z': 12, 'W': 12, 'Y': 1}):  # dense, unique
+        dat = samples(5000, sizes)
+        table = CountTable.from_samples(dat)
+        assert table.n == 5000
+        assert (table.codes[1:] > table.codes[:-1]).all()
+        back = table.to_samples()
+        assert list(back) == list(sizes)
+        (rows, counts), (rows2, counts2) = sorted_rows(dat), sorted_rows(back)
+        assert T.equal(rows, rows2)
+        assert T.equal(counts, counts2)
+
+
+def test_merge_and_dense():
+    T.manual_seed(0)
+    sizes = {'X': 1, 'Z': 2, 'Y': 1}
+    a, b = samples(300, sizes), samples(700, sizes)
+    merged = CountTable.from_samples(a) + CountTable.from_samples(b)
+    whole = CountTable.from_samples({k: T.cat((a[k], b[k])) for k in sizes})
+    assert T.equal(merged.codes, whole.codes)
+    assert T.equal(merged.counts, whole.counts)
+    assert T.equal(CountTable.from_dense(sizes, whole.dense()).counts, whole.counts)
+
+
+def test_probabilities_lookup():
+    table = CountTable({'X': 1, 'Y': 1}, T.tensor([1, 2]), T.tensor([1, 3]))
+    probs = table.probabilities()
+    assert T.allclose(probs.lookup(T.tensor([0, 1, 2, 3])),
+                      T.tensor([0., 0.25, 0.75, 0.], dtype=T.float64))
+    reordered = probs.reorder({'Y': 1, 'X': 1})
+    assert isinstance(reordered, ProbabilityTable)
+    assert T.allclose(reordered.lookup(T.tensor([1, 2])),
+                      T.tensor([0.75, 0.25], dtype=T.float64))
@@ -0,0 +1,67 @@
+import numpy as np
+import torch as T
+
+from src.scm import CTM
+
+
+def enumerate_table(ctm, do={}):
+    # P(V | do) by summing P(u) over every configuration of U
+    select = [k for k in ctm.v if k not in do]
+    do = {k: T.tensor([[val]]) for k, val in do.items()}
+    t = T.zeros((2,) * len(select), dtype=T.float64)
+    with T.no_grad():
+        for u in ctm.pu.space():
+            p = T.exp(ctm.pu.log_pmf({k: int(val) for k, val in u.items()})).double()
+            v = ctm(u=u, do=do)
+            t[tuple(int(v[k]) for k in select)] += p
+    return t
+
+
+def test_table_matches_enumeration():
+    T.manual_seed(0)
+    for graph in ('backdoor', 'frontdoor', 'iv', 'napkin'):
+        ctm = CTM(f'dat/cg/{graph}.cg').eval()
+        assert T.allclose(ctm.table().double(), enumerate_table(ctm), atol=1e-6)
+        assert T.allclose(ctm.table(do={'X': 1}).double(), enumerate_table(ctm, {'X': 1}),
+                          atol=1e-6)
+
+
+def test_log_pmf_marginal():
+    T.manual_seed(0)
+    ctm = CTM('dat/cg/frontdoor.cg').eval()
+    t = enumerate_table(ctm, {'X': 0})
+    y = [k for k in ctm.v if k != 'X'].index('Y')
+    for val in (0, 1):
+        p = t.select(y, val).sum()
+        assert abs(ctm.pmf({'Y': T.tensor([[val]])}, do={'X': T.tensor([[0]])}) - p) < 1e-6
+
+
+def test_sample_table():
+    T.manual_seed(0)
+    np.random.seed(0)
+    ctm = CTM('dat/cg/backdoor.cg').eval()
+    pv = ctm.table().flatten().double()
+    counts = ctm.sample_table(100000, counts=True)
+    assert counts.sum() == 100000
+    assert (counts.double() / 100000 - pv).abs().max() < 0.01
+    dat = ctm.sample_table(100000)
+    codes = sum(dat[k].flatten() << (len(ctm.v) - 1 - i) for i, k in enumerate(ctm.v))
+    freq = T.bincount(codes, minlength=len(pv)).double() / 100000
+    assert (freq - pv).abs().max() < 0.01
+
+
+def test_table_cache():
+    T.manual_seed(0)
+    ctm = CTM('dat/cg/backdoor.cg')
+    with T.no_grad():
+        t = ctm.table()
+        assert ctm.table() is t
+    opt = T.optim.SGD(ctm.parameters(), lr=0.1)
+    for _ in range(2):  # differentiable tables are not cached, so each step has its own graph
+        opt.zero_grad()
+        loss = -T.log(ctm.table()).sum()
+        loss.backward()
+        opt.step()
+    assert all(not t.requires_grad for _, t in ctm.tables.values())
+    with T.no_grad():
+        assert ctm.table() is not t  # the parameters changed
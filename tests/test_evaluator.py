@@ -0,0 +1,43 @@
+from types import SimpleNamespace
+
+import torch as T
+
+from src.metric.evaluator import AsyncEvaluator, snapshot
+from src.pipeline import NLLCTMPipeline
+from src.scm import CTM
+
+CG = 'dat/cg/backdoor.cg'
+
+
+def test_snapshot_detaches_cached_graphs():
+    ctm = CTM(CG)
+    t = ctm.table()
+    assert t.grad_fn is not None
+    ctm.tables['graph'] = (None, t)  # a cache holding a tensor of the autograd graph
+    copy = snapshot(ctm)
+    assert not copy.tables['graph'][1].requires_grad
+    assert all(not p.requires_grad for p in copy.parameters())
+    assert all(p.requires_grad for p in ctm.parameters())
+    ctm.tables['graph'][1].sum().backward()  # the original graph is untouched
+
+
+def test_evaluate_metrics_after_grad_table():
+    T.manual_seed(0)
+    truth = CTM(CG).eval()
+    m = NLLCTMPipeline(truth, truth.sample_table(1000), CG)
+    m.async_metrics = False
+    m.native = SimpleNamespace(global_step=5, current_epoch=0, logger=None)
+    m.ncm.table().sum().backward()
+    m.evaluate_metrics(1000)
+    (epoch, results), = m.log_evaluations()
+    assert epoch == 0
+    assert 'kl' in results
+
+
+def test_background_results():
+    T.manual_seed(0)
+    truth = CTM(CG).eval()
+    evaluator = AsyncEvaluator(truth, truth.sample_table(1000), CG)
+    evaluator.submit(CTM(CG), 1000, 1, 0)
+    (step, epoch, results), = evaluator.results(wait=True)
+    assert (step, epoch) == (1, 0)
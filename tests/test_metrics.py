@@ -0,0 +1,45 @@
+import numpy as np
+import torch as T
+import torch.nn as nn
+
+from src.metric import metrics
+
+
+class Fixed(nn.Module):
+    # a model whose samples are given
+    def __init__(self, dat):
+        super().__init__()
+        self.dat = dat
+        self.device_param = nn.Parameter(T.empty(0))
+
+    def forward(self, n=1, do={}):
+        return self.dat
+
+
+def samples(n, n_vars, seed):
+    g = T.Generator().manual_seed(seed)
+    return {f'V{i}': T.randint(0, 2, (n, 1), generator=g) for i in range(n_vars)}
+
+
+def test_narrow_codes_match_frames():
+    a, b = samples(2000, 3, 0), samples(2000, 3, 1)
+    t_table = metrics.probability_codes(dat=a)
+    m_table = metrics.probability_codes(dat=b)
+    p_t, p_m = metrics._joined_frames(t_table, m_table, 'left', 0.0000001)
+    expected = float((p_t * (np.log(p_t) - np.log(p_m))).sum())
+    assert abs(metrics.kl(Fixed(a), Fixed(b)) - expected) < 1e-9
+    p_t, p_m = metrics._joined_frames(t_table, m_table, 'outer', 0.0)
+    assert abs(metrics.supremum_norm(Fixed(a), Fixed(b)) - float((p_m - p_t).abs().max())) < 1e-9
+
+
+def test_wide_tables():
+    # more bits than fit in one int64 code
+    a = samples(500, 70, 0)
+    a = {k: T.cat((v, v[:100])) for k, v in a.items()}
+    b = samples(600, 70, 1)
+    table = metrics.probability_table(dat=a)
+    assert len(table) == 500
+    assert abs(table['P(V)'].sum() - 1) < 1e-9
+    assert sorted(np.round(table['P(V)'].unique() * 600)) == [1, 2]
+    assert metrics.kl(Fixed(a), Fixed(a)) == 0
+    assert abs(metrics.supremum_norm(Fixed(a), Fixed(b)) - 2 / 600) < 1e-9
@@ -0,0 +1,58 @@
+import os
+
+import torch as T
+
+from src.ds import CausalGraph
+from src.scm import NCM
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CG = os.path.join(ROOT, 'dat/cg/backdoor.cg')
+
+
+def test_chunked_logsumexp_matches_full():
+    ncm = NCM(CausalGraph.read(CG))
+    x = T.randn(103, requires_grad=True)
+    pos = [0]
+
+    def f(c, _):
+        t = x[pos[0]:pos[0] + c]
+        pos[0] += c
+        return T.logsumexp(t, dim=0)
+
+    chunked = ncm._chunked_logsumexp(f, len(x), 10)
+    grad, = T.autograd.grad(chunked, x)
+    full = T.logsumexp(x, dim=0)
+    expected, = T.autograd.grad(full, x)
+    assert T.allclose(chunked, full)
+    assert T.allclose(grad, expected)
+
+
+def test_chunked_biased_nll_matches_full():
+    T.manual_seed(0)
+    ncm = NCM(CausalGraph.read(CG))
+    for v in ncm.space():
+        with T.no_grad():
+            full = ncm.biased_nll(v, n=200000)
+            chunked = ncm.biased_nll(v, n=200000, chunk_size=30000)
+        assert abs(full.item() - chunked.item()) < 0.02
+
+
+def test_chunked_sumo_matches_full():
+    T.manual_seed(0)
+    ncm = NCM(CausalGraph.read(CG))
+    v = next(ncm.space())
+    with T.no_grad():
+        exact = ncm.biased_nll(v, n=500000).item()
+        full = ncm.nll(v, n=50, m=2000).item()
+        chunked = ncm.nll(v, n=50, m=2000, chunk_size=500).item()
+    assert abs(full - exact) < 0.05
+    assert abs(chunked - exact) < 0.05
+
+
+def test_sumo_groups():
+    ncm = NCM(CausalGraph.read(CG))
+    v = next(ncm.space())
+    with T.no_grad():
+        nll, biased = ncm.nll(v, n=4, m=100, return_biased=True, reduce=False)
+    assert nll.shape == (1, 4)
+    assert biased.dim() == 0
@@ -0,0 +1,50 @@
+from types import SimpleNamespace
+
+import torch as T
+
+from src.pipeline import NLLNCMPipeline
+from src.scm import CTM
+
+CG = 'dat/cg/backdoor.cg'
+
+
+def test_sem_from_one_pass():
+    T.manual_seed(0)
+    truth = CTM(CG).eval()
+    m = NLLNCMPipeline(truth, truth.sample_table(1000), CG)
+    logged = {}
+    m.native = SimpleNamespace(optimizer=T.optim.SGD(m.ncm.parameters(), lr=0.), current_epoch=0,
+                               global_step=0, logger=None,
+                               log=lambda name, value: logged.__setitem__(name, float(value)))
+    param = next(m.ncm.parameters())
+    calls = []
+
+    def nll(v, n=1, m=100000, return_biased=False, chunk_size=None, reduce=True):
+        # n independent estimates per call, recorded with the arguments
+        assert reduce is False and return_biased
+        est = T.rand(1, n) + 0 * param.sum()
+        calls.append((n, m, est.detach().flatten()))
+        return est, est.detach().mean()
+
+    m.ncm.nll = nll
+    m.accumulate_batches = 2
+    space, nlpvs = m.step_targets(None)
+    m.training_step(None, 0)
+
+    # each configuration is estimated once per accumulated batch, with n_groups estimators
+    assert len(calls) == 2 * len(space)
+    assert all(n == m.n_groups and k == int(1.6e6) // m.n_groups for n, k, _ in calls)
+    losses = T.zeros(2, m.n_groups)
+    for i, (_, _, est) in enumerate(calls):
+        nlpv = nlpvs[i % len(space)]
+        losses[i // len(space)] += T.exp(-nlpv) * (est - nlpv)
+    losses = losses.flatten()
+    assert abs(logged['train_loss'] - losses.mean().item()) < 1e-4
+    assert abs(logged['sem'] - (losses.std() / len(losses) ** .5).item()) < 1e-4
+
+    # a relative SEM above 0.25 doubles the accumulated batches of the next step
+    m.last_loss, m.last_loss_sem = T.tensor(1.), T.tensor(0.5)
+    calls.clear()
+    m.training_step(None, 1)
+    assert m.accumulate_batches == 4
+    assert len(calls) == 4 * len(space)
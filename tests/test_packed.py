@@ -0,0 +1,39 @@
+import os
+
+import torch as T
+
+from src.ds import CausalGraph
+from src.scm.distribution import BernoulliDistribution
+from src.scm.distribution.discrete import pack_bits, unpack_bits
+from src.scm.model_families import XORModel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_pack_bits_round_trip():
+    for n in (1, 63, 64, 65, 200):
+        x = T.randint(0, 2, (n, 3))
+        words = pack_bits(x)
+        assert words.shape == (-(-n // 64), 3)
+        assert T.equal(unpack_bits(words, n), x)
+
+
+def test_sample_packed_mean():
+    for p in (0., 0.1, 0.5, 0.9, 1.):
+        pu = BernoulliDistribution(['U'], {'U': 2}, p=p, seed=0)
+        u = unpack_bits(pu.sample_packed(64 * 2000)['U'], 64 * 2000)
+        assert abs(u.double().mean().item() - p) < 0.01
+
+
+def test_packed_samples_match_table():
+    T.manual_seed(0)
+    m = XORModel(CausalGraph.read(f'{ROOT}/dat/cg/frontdoor.cg'), dim=2, p=0.3, seed=0)
+    n = 200000
+    dat = m(n)
+    codes = T.zeros(n, dtype=T.long)
+    for k in m.v:
+        for i in range(dat[k].shape[1]):
+            codes = (codes << 1) | dat[k][:, i].long()
+    pv = m.table().flatten().double()
+    freq = T.bincount(codes, minlength=len(pv)).double() / n
+    assert (freq - pv).abs().max() < 0.01
@@ -0,0 +1,61 @@
+import socket
+
+import torch as T
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+
+from src.pipeline.base_pipeline import BasePipeline
+
+N_CONFIGS = 11
+
+
+def pipeline():
+    T.manual_seed(0)
+    m = BasePipeline(None, None, None, nn.Linear(3, 1))
+    configs = [T.randn(1, 3) for _ in range(N_CONFIGS)]
+    m.configurations = lambda: configs
+    m.nlpvs = T.rand(N_CONFIGS)
+    return m
+
+
+def step(m):
+    space, nlpvs = m.step_targets(None)
+    loss = 0
+    for x, nlpv in zip(space, nlpvs):
+        loss = loss + T.exp(-nlpv) * (m.ncm(x).sum() - nlpv) ** 2
+    loss.backward()
+    m.sync_gradients()
+    return (m.all_reduce(float(loss)),
+            T.cat([p.grad.flatten() for p in m.ncm.parameters()]))
+
+
+def worker(queue, rank, world_size, port):
+    dist.init_process_group('gloo', init_method=f'tcp://127.0.0.1:{port}', rank=rank,
+                            world_size=world_size)
+    try:
+        queue.put((rank, step(pipeline())))
+    finally:
+        dist.destroy_process_group()
+
+
+def test_sharded_gradients_sum_to_full():
+    expected_loss, expected_grad = step(pipeline())
+    ctx = mp.get_context('fork')
+    queue = ctx.Queue()
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    world_size = 3
+    processes = [ctx.Process(target=worker, args=(queue, rank, world_size, port))
+                 for rank in range(world_size)]
+    for p in processes:
+        p.start()
+    results = dict(queue.get(timeout=120) for _ in processes)
+    for p in processes:
+        p.join()
+        assert p.exitcode == 0
+    for rank in range(world_size):
+        loss, grad = results[rank]
+        assert abs(loss - expected_loss) < 1e-4
+        assert T.allclose(grad, expected_grad, atol=1e-5)
@@ -0,0 +1,54 @@
+from types import SimpleNamespace
+
+import pytest
+import torch as T
+import torch.nn as nn
+
+from src.pipeline import NLLNCMMaxPipeline
+from src.pipeline.base_pipeline import BasePipeline
+
+
+def sparse_pipeline(unseen_mass):
+    m = BasePipeline(None, None, None, nn.Module())
+    m.native = SimpleNamespace()  # manual_backward calls backward() directly
+    m.sparse = True
+    m.unseen_mass = unseen_mass
+    return m
+
+
+def test_backward_target_matches_joint_backward():
+    T.manual_seed(0)
+    theta = nn.Parameter(T.randn(8))
+    nlpvs = -T.log(T.tensor([0.3, 0.2, 0.15, 0.1, 0.05]))
+
+    def nlls():
+        return -T.log_softmax(theta, dim=0)[:len(nlpvs)]
+
+    m = sparse_pipeline(0.2)
+    nll = nlls()
+    loss = (T.exp(-nlpvs) * (nll - nlpvs)).sum() + m.unseen_loss(list(nll))
+    expected, = T.autograd.grad(loss, theta)
+    unseen = m.unseen_loss(list(nll)).item()
+
+    # one configuration at a time, with the seen mass of the current parameters
+    m.seen_mass = T.exp(-nll).sum().item()
+    values = []
+    for i, nlpv in enumerate(nlpvs):
+        nll = nlls()[i]
+        m.backward_target(T.exp(-nlpv) * (nll - nlpv), nll)
+        values.append(nll.item())
+    assert T.allclose(theta.grad, expected, atol=1e-6)
+    assert abs(m.unseen_value(values) - unseen) < 1e-6
+    assert abs(m.seen_mass - T.exp(-nlls()).sum().item()) < 1e-6
+
+
+def test_backward_target_weight():
+    theta = nn.Parameter(T.tensor(0.5))
+    m = sparse_pipeline(0.)
+    m.backward_target(theta ** 2, theta, weight=0.25)
+    assert abs(theta.grad.item() - 0.25) < 1e-6
+
+
+def test_max_pipeline_rejects_large_graphs():
+    with pytest.raises(ValueError):
+        NLLNCMMaxPipeline(None, None, 'dat/cg/25-ch.cg')
@@ -0,0 +1,42 @@
+import itertools
+import os
+
+import torch as T
+
+from src.ds import CausalGraph
+from src.scm.model_families import XORModel
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def enumerate_table(m, do={}):
+    # P(V | do) by summing P(u) over every configuration of the noise bits
+    d = sum(m.sizes[k] for k in m.v)
+    t = T.zeros(2 ** d, dtype=T.float64)
+    names = list(m.pu.sizes)
+    n_bits = sum(m.pu.sizes.values())
+    for bits in itertools.product((0, 1), repeat=n_bits):
+        it = iter(bits)
+        u = {k: T.tensor([[next(it) for _ in range(m.pu.sizes[k])]]) for k in names}
+        v = m(u=u, do=do, packed=False)
+        code = 0
+        for k in m.v:
+            for b in v[k].flatten().tolist():
+                code = (code << 1) | b
+        t[code] += m.p ** sum(bits) * (1 - m.p) ** (n_bits - sum(bits))
+    return t.reshape((2,) * d)
+
+
+def test_table_matches_enumeration():
+    for graph in ('backdoor', 'frontdoor', 'iv'):
+        m = XORModel(CausalGraph.read(f'{ROOT}/dat/cg/{graph}.cg'), dim=2, p=0.3)
+        assert T.allclose(m.table().double(), enumerate_table(m), atol=1e-6)
+        do = {'X': T.tensor([[1]])}
+        assert T.allclose(m.table(do=do).double(), enumerate_table(m, do), atol=1e-6)
+
+
+def test_pmf_marginal():
+    m = XORModel(CausalGraph.read(f'{ROOT}/dat/cg/frontdoor.cg'), dim=2, p=0.2)
+    t = m.table(do={'X': T.tensor([[0]])}, select=['Y'])
+    assert abs(t.sum().item() - 1) < 1e-6
+    assert abs(m.pmf({'Y': T.tensor([[1]])}, do={'X': T.tensor([[0]])}) - t[1].item()) < 1e-6